@@ -0,0 +1,200 @@
+"""Time stages of the diff and merge pipeline on synthetic scores.
+
+Run from the repository root::
+
+    python -m benchmarks.bench --save results.json
+    python -m benchmarks.bench --compare results.json
+
+Every stage is timed REPEAT times and the best time is kept. Peak memory
+of every stage is measured in a separate run with tracemalloc, so that
+tracing doesn't slow down the timed runs.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import guitarpro
+
+from gpdiff import diffutil, flatten, merge
+from gpdiff.differ import GPDiffer, make_matcher
+
+from . import scores
+
+EDITS = ('scattered', 'insert', 'retune', 'reorder')
+
+
+def make_songs(args):
+    """Build base song O and descendants A and B with edits applied."""
+    def score():
+        return scores.make_score(args.tracks, args.measures, args.beats)
+
+    def edit(song, pattern, seed):
+        if pattern == 'scattered':
+            return scores.scattered_edits(song, count=args.edits, beats=args.beats, seed=seed)
+        elif pattern == 'insert':
+            return scores.block_insert(song, count=args.edits, beats=args.beats, seed=seed)
+        elif pattern == 'retune':
+            return scores.retune(song)
+        else:
+            return scores.reorder_tracks(song, seed=seed)
+
+    mine = edit(score(), args.mine, seed=1)
+    yours = edit(score(), args.yours, seed=2)
+    return [mine, score(), yours]
+
+
+def stages(args, songs, files):
+    """Return list of pipeline stages as pairs (name, function).
+
+    Every function takes the result of the previous stage.
+    """
+    matcher = make_matcher(args.algorithm, args.max_cost)
+
+    def flatten_songs(songs):
+        return [flatten.flatten(song, view=True) for song in songs]
+
+    def intern(sequences):
+        interner = flatten.Interner()
+        return sequences, [interner.intern(s) for s in sequences]
+
+    def match(data):
+        sequences, keys = data
+        results = [diffutil.match(matcher, keys[1], keys[i]) for i in (0, 2)]
+        return sequences, keys, results
+
+    def merge_diffs(data):
+        sequences, keys, results = data
+        return GPDiffer(files, songs, sequences=sequences, keys=keys, results=results,
+                        algorithm=args.algorithm, max_cost=args.max_cost)
+
+    def show(differ):
+        for _ in differ.show():
+            pass
+        return differ
+
+    def merge_3_files(differ):
+        merger = merge.Merger()
+        merger.differ = differ
+        merger.texts = differ._sequences
+        return list(merger.merge_3_files())
+
+    def restore(merged):
+        return flatten.restore(merged)
+
+    return [
+        ('flatten', flatten_songs),
+        ('intern', intern),
+        ('match', match),
+        ('merge_diffs', merge_diffs),
+        ('show', show),
+        ('merge_3_files', merge_3_files),
+        ('restore', restore),
+    ]
+
+
+def run(args):
+    """Run the benchmark and return the results."""
+    songs = make_songs(args)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # GPDiffer.show reports modification times of files
+        files = [os.path.join(tmp_dir, f'{name}.gp5') for name in 'AOB']
+        for song, path in zip(songs, files):
+            guitarpro.write(song, path)
+        results = measure(stages(args, songs, files), songs, args.repeat)
+    params = {name: getattr(args, name)
+              for name in ('tracks', 'measures', 'beats', 'mine', 'yours', 'edits',
+                           'algorithm', 'max_cost', 'repeat')}
+    return {
+        'params': params,
+        'python': platform.python_version(),
+        'stages': results,
+    }
+
+
+def measure(pipeline, songs, repeat):
+    """Return best time and peak memory of every stage of *pipeline*."""
+    results = {}
+    for _ in range(repeat):
+        data = songs
+        for name, stage in pipeline:
+            start = time.perf_counter()
+            data = stage(data)
+            elapsed = time.perf_counter() - start
+            best = results.setdefault(name, {}).get('time')
+            if best is None or elapsed < best:
+                results[name]['time'] = elapsed
+
+    data = songs
+    for name, stage in pipeline:
+        tracemalloc.start()
+        data = stage(data)
+        results[name]['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Return list of descriptions of stages that got slower than in
+    *baseline* by more than *threshold* times."""
+    regressions = []
+    for name, stage in results['stages'].items():
+        base = baseline['stages'].get(name)
+        if base is None:
+            continue
+        ratio = stage['time'] / base['time'] if base['time'] else 1
+        if ratio > threshold:
+            regressions.append(f'{name}: {base["time"]:.4f}s -> {stage["time"]:.4f}s ({ratio:.2f}x)')
+    return regressions
+
+
+def print_results(results):
+    print('{:<14} {:>10} {:>12}'.format('stage', 'time, s', 'peak, KiB'))
+    for name, stage in results['stages'].items():
+        print('{:<14} {:>10.4f} {:>12.1f}'.format(name, stage['time'], stage['peak_memory'] / 1024))
+
+
+parser = argparse.ArgumentParser(prog='python -m benchmarks.bench', description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--tracks', type=int, default=4)
+parser.add_argument('--measures', type=int, default=200)
+parser.add_argument('--beats', type=int, default=8, help='beats per measure')
+parser.add_argument('--mine', choices=EDITS, default='scattered', help='edit pattern of song A')
+parser.add_argument('--yours', choices=EDITS, default='insert', help='edit pattern of song B')
+parser.add_argument('--edits', type=int, default=20, help='number of edited or inserted measures')
+parser.add_argument('-a', '--algorithm', default='myers')
+parser.add_argument('--max-cost', type=int)
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--save', metavar='FILE', help='save results to FILE as JSON')
+parser.add_argument('--compare', metavar='FILE', help='compare timings with results saved in FILE')
+parser.add_argument('--threshold', type=float, default=1.25,
+                    help='slowdown ratio reported as regression (default: %(default)s)')
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    results = run(args)
+    print_results(results)
+    if args.save is not None:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if baseline['params'] != results['params']:
+            print('warning: parameters differ from baseline', file=sys.stderr)
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print('regression:', line)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
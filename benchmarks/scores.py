@@ -0,0 +1,87 @@
+"""Synthetic scores for benchmarks."""
+
+import copy
+import random
+
+import guitarpro as gp
+
+DURATIONS = (1, 2, 4, 8, 16)
+
+
+def make_score(tracks=4, measures=200, beats=8, seed=0):
+    """Build a song with given number of *tracks*, *measures* per track and
+    *beats* per measure, filled with pseudo-random notes."""
+    rng = random.Random(seed)
+    song = gp.Song(tracks=[], measureHeaders=[])
+    for number in range(1, measures + 1):
+        song.measureHeaders.append(gp.MeasureHeader(number=number))
+    for number in range(1, tracks + 1):
+        track = gp.Track(song, number=number, name=f'Track {number}', measures=[])
+        for header in song.measureHeaders:
+            measure = gp.Measure(track, header)
+            fill_measure(measure, beats, rng)
+            track.measures.append(measure)
+        song.tracks.append(track)
+    return song
+
+
+def fill_measure(measure, beats, rng):
+    """Replace beats of the first voice of *measure* with *beats* random
+    notes."""
+    voice = measure.voices[0]
+    voice.beats = []
+    for _ in range(beats):
+        beat = gp.Beat(voice, status=gp.BeatStatus.normal,
+                       duration=gp.Duration(value=rng.choice(DURATIONS)))
+        string = rng.randint(1, 6)
+        beat.notes.append(gp.Note(beat, value=rng.randint(0, 24), string=string,
+                                  type=gp.NoteType.normal))
+        voice.beats.append(beat)
+
+
+def renumber(song):
+    for number, header in enumerate(song.measureHeaders, start=1):
+        header.number = number
+    for number, track in enumerate(song.tracks, start=1):
+        track.number = number
+
+
+def scattered_edits(song, count=20, beats=8, seed=1):
+    """Rewrite *count* random measures of random tracks."""
+    rng = random.Random(seed)
+    for _ in range(count):
+        track = rng.choice(song.tracks)
+        fill_measure(rng.choice(track.measures), beats, rng)
+    return song
+
+
+def block_insert(song, count=16, beats=8, seed=2):
+    """Insert *count* new measures into every track in the middle of the
+    song."""
+    rng = random.Random(seed)
+    position = len(song.measureHeaders) // 2
+    for i in range(count):
+        header = gp.MeasureHeader()
+        song.measureHeaders.insert(position + i, header)
+        for track in song.tracks:
+            measure = gp.Measure(track, header)
+            fill_measure(measure, beats, rng)
+            track.measures.insert(position + i, measure)
+    renumber(song)
+    return song
+
+
+def retune(song):
+    """Drop the tuning of the lowest string of every other track."""
+    for track in song.tracks[::2]:
+        track.strings = copy.deepcopy(track.strings)
+        track.strings[-1].value -= 2
+    return song
+
+
+def reorder_tracks(song, seed=4):
+    """Shuffle tracks of the song."""
+    rng = random.Random(seed)
+    rng.shuffle(song.tracks)
+    renumber(song)
+    return song
@@ -0,0 +1,37 @@
+import hashlib
+import io
+
+import guitarpro
+
+from . import flatten
+from . import timings
+
+
+def digest(data):
+    """Return hex digest of file contents *data*."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_digest(path):
+    """Return hex digest of contents of file at *path*."""
+    with open(path, 'rb') as fp:
+        return digest(fp.read())
+
+
+def load(path):
+    """Parse file at *path* and flatten the song.
+
+    :returns: tuple (song, flat sequence).
+    """
+    with open(path, 'rb') as fp:
+        return parse(fp.read())
+
+
+def parse(data):
+    """Parse file contents *data* and flatten the song."""
+    with timings.stage('parse'):
+        song = guitarpro.parse(io.BytesIO(data))
+    with timings.stage('flatten') as metrics:
+        sequence = flatten.flatten(song, view=True)
+        metrics['elements'] = len(sequence)
+    return song, sequence
@@ -0,0 +1,16 @@
+import json
+import socket
+
+
+def request(path, payload):
+    """Send request *payload* to the server listening on socket *path* and
+    return the response, see :mod:`gpdiff.server`."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        with sock.makefile('rwb') as fp:
+            fp.write(json.dumps(payload).encode() + b'\n')
+            fp.flush()
+            line = fp.readline()
+    if not line:
+        raise ConnectionError('server closed the connection')
+    return json.loads(line)
@@ -0,0 +1,481 @@
+"""Diff and merge of parsed songs behind the command line interface.
+
+This module is imported only when files are actually compared, to keep
+startup of :mod:`gpdiff.gpdiff` fast.
+"""
+
+import bisect
+import functools
+import itertools
+import json
+import os
+import time
+
+import attr
+import guitarpro
+
+from . import cache
+from . import diffutil
+from . import flatten
+from . import hierarchy
+from . import merge
+from . import myers
+from . import patience
+from . import timings
+
+
+class MergeError(Exception):
+    """Songs can't be merged."""
+
+
+def execute(files, songs, sequences, fmt='text', output=None, batch=False, executor=None, **options):
+    """Diff or merge parsed *files* as the command line does.
+
+    :param files: list of file names: [O, A1, A2, ...] if *batch* is true,
+        [A, O] or [A, O, B] otherwise.
+    :param output: optional path to write the merged song to in 3-way
+        mode.
+    :param options: keyword arguments of :class:`GPDiffer`.
+    :returns: tuple (exit status, iterator of report lines).
+    """
+    if batch:
+        differs = GPDiffer.batch(files, songs, sequences=sequences, executor=executor, **options)
+        return 0, batch_report(differs, fmt)
+    differ = GPDiffer(files, songs, sequences=sequences, executor=executor, **options)
+    if len(files) == 3 and output is not None:
+        result = differ.merge()
+        max_version = max(song.versionTuple for song in songs)
+        with timings.stage('write'):
+            guitarpro.write(result, output, version=max_version)
+        if not differ.conflicts:
+            # The merged song is written, nothing to report
+            return 0, iter([json.dumps([])] if fmt == 'json' else [])
+    status = 1 if len(files) == 3 and differ.conflicts else 0
+    return status, report(differ, fmt)
+
+
+def diff_files(old, new, fmt='text', **kwargs):
+    """Parse and diff files *old* and *new*, and return the report as list
+    of lines that can be sent back from a worker of the directory diff."""
+    songs, sequences = load([new, old])
+    differ = GPDiffer([new, old], songs, sequences=sequences, **kwargs)
+    return list(report(differ, fmt))
+
+
+def load(files):
+    """Parse and flatten *files* one after another.
+
+    Parsing is not parallel: the parser is pure Python and holds the GIL,
+    and pickling parsed songs back from worker processes takes longer than
+    parsing them.
+
+    :returns: tuple (songs, sequences).
+    """
+    loaded = [cache.load(path) for path in files]
+    songs = [song for song, _ in loaded]
+    sequences = [sequence for _, sequence in loaded]
+    return songs, sequences
+
+
+def report(differ, fmt='text'):
+    """Return lines of report of *differ* in format *fmt*."""
+    if fmt == 'text':
+        return differ.show()
+    else:
+        return differ.show_json(ndjson=fmt == 'ndjson')
+
+
+def batch_report(differs, fmt='text'):
+    """Return lines of reports of *differs*.
+
+    Text reports are separated by empty lines. In JSON formats, records
+    of all *differs* make up one array or stream, and the *file* of every
+    record tells which descendant it belongs to.
+    """
+    if fmt != 'text':
+        records = itertools.chain.from_iterable(differ.records() for differ in differs)
+        yield from json_lines(records, ndjson=fmt == 'ndjson')
+        return
+    for i, differ in enumerate(differs):
+        if i > 0:
+            yield ''
+        yield from differ.show()
+
+
+def json_lines(records, ndjson=False):
+    """Return lines of a JSON array of *records*, or of newline-delimited
+    JSON if *ndjson* is True."""
+    if ndjson:
+        for record in records:
+            yield json.dumps(record)
+        return
+    previous = None
+    for record in records:
+        if previous is None:
+            yield '['
+        else:
+            yield f'  {previous},'
+        previous = json.dumps(record)
+    if previous is None:
+        yield json.dumps([])
+    else:
+        yield f'  {previous}'
+        yield ']'
+
+
+matchers = {
+    'myers': myers.MyersSequenceMatcher,
+    'linear': myers.LinearMyersSequenceMatcher,
+    'patience': patience.PatienceSequenceMatcher,
+}
+
+
+def make_matcher(algorithm='myers', max_cost=None, executor=None):
+    """Return matcher of flattened songs that compares song attributes and
+    pairs of tracks with given *algorithm*, see
+    :class:`gpdiff.hierarchy.HierarchicalMatcher`."""
+    submatcher = functools.partial(matchers[algorithm], max_cost=max_cost)
+    return functools.partial(hierarchy.HierarchicalMatcher,
+                             submatcher=submatcher, executor=executor)
+
+
+def format_value(attr, value):
+    """Format value of attribute *attr* for output."""
+    if isinstance(value, tuple):
+        if attr == 'strings':
+            value = reversed(value)
+            return '({})'.format(', '.join(map(str, value)))
+        else:
+            return str(value)
+    elif isinstance(value, str):
+        return repr(value)
+    elif isinstance(value, guitarpro.Lyrics):
+        return repr(str(value))
+    else:
+        return str(value)
+
+
+@attr.s
+class GPDiffer(diffutil.Differ):
+    """A Differ instance with given songs.
+
+    :param files: list of 2 or 3 file names: [A, O, B] or [A, O].
+    :param songs: list of 2 or 3 parsed tabs.
+    :param sequences: optional list of flattened *songs*, e.g. loaded
+        from cache.
+    :param executor: optional executor to compute O→A and O→B diffs in
+        parallel if they are expensive enough, see
+        :attr:`gpdiff.diffutil.Differ.parallel_cost`, or to compare
+        expensive pairs of tracks in parallel in 2-file mode.
+    :param algorithm: name of the diff algorithm in :data:`matchers`.
+    :param max_cost: optional cost limit of the Myers diff, see
+        :class:`gpdiff.myers.MyersSequenceMatcher`.
+    :param keys: optional list of interned *sequences* that share one
+        :class:`gpdiff.flatten.Interner`.
+    :param interner: optional interner that produced *keys*, used to
+        intern elements passed to :meth:`change_sequence`.
+    :param results: optional list of :func:`gpdiff.diffutil.match`
+        results computed in advance, see :meth:`batch`.
+    """
+
+    files = attr.ib(default=attr.Factory(list))
+    songs = attr.ib(default=attr.Factory(list))
+    sequences = attr.ib(default=None)
+    executor = attr.ib(default=None)
+    algorithm = attr.ib(default='myers')
+    max_cost = attr.ib(default=None)
+    keys = attr.ib(default=None, repr=False)
+    interner = attr.ib(default=None, repr=False)
+    results = attr.ib(default=None, repr=False)
+
+    def __attrs_post_init__(self):
+        super().__init__()
+        self.files = self.files[:]
+        self.songs = self.songs[:]
+        if self.sequences is None:
+            self._sequences = [flatten.flatten(song, view=True) for song in self.songs]
+        else:
+            self._sequences = list(self.sequences)
+        executor = self.executor if len(self.songs) == 2 else None
+        self._matcher = make_matcher(self.algorithm, self.max_cost, executor)
+        if self.keys is None:
+            self._interner = flatten.Interner()
+            with timings.stage('intern') as metrics:
+                self._keys = [self._interner.intern(s) for s in self._sequences]
+                metrics['tokens'] = sum(map(len, self._keys))
+                metrics['distinct'] = len(self._interner.table)
+        else:
+            self._interner = self.interner
+            self._keys = list(self.keys)
+        self._track_starts = [[start for start, _, _ in keys.tracks] for keys in self._keys]
+        self.set_sequences_iter(self._sequences, self._keys, self.results)
+
+    def _keys_of(self, elements):
+        if self._interner is None:
+            # Keys were interned elsewhere, recover the table from them
+            self._interner = flatten.Interner.recover(self._sequences, self._keys)
+        return self._interner.intern(elements)
+
+    def _join_keys(self, sequence, keys):
+        return flatten.Tokens(keys, flatten.track_spans(sequence))
+
+    def change_sequence(self, pane, start, removed, inserted):
+        super().change_sequence(pane, start, removed, inserted)
+        self._sequences[pane] = self._texts[pane]
+        self._track_starts[pane] = [start for start, _, _ in self._keys[pane].tracks]
+
+    @classmethod
+    def batch(cls, files, songs, sequences=None, executor=None, keys=None, interner=None, **kwargs):
+        """Diff the first song against each of the other songs.
+
+        The first song is flattened and interned once, and the diffs are
+        computed on *executor* if it's given.
+
+        :param files: list of file names: [O, A1, A2, ...].
+        :param songs: list of parsed tabs.
+        :param keys: optional list of interned *sequences*, as in
+            :class:`GPDiffer`.
+        :param interner: optional interner that produced *keys*.
+        :returns: iterator of GPDiffer instances, one for every Ai.
+        """
+        if sequences is None:
+            sequences = [flatten.flatten(song, view=True) for song in songs]
+        if keys is None:
+            interner = flatten.Interner()
+            keys = [interner.intern(s) for s in sequences]
+        count = len(songs) - 1
+        args = ([make_matcher(kwargs.get('algorithm', 'myers'), kwargs.get('max_cost'))] * count,
+                [keys[0]] * count,
+                keys[1:])
+        if executor is not None:
+            results = executor.map(diffutil.match, *args)
+        else:
+            results = map(diffutil.match, *args)
+        for i, result in enumerate(results, start=1):
+            yield cls([files[i], files[0]], [songs[i], songs[0]],
+                      sequences=[sequences[i], sequences[0]],
+                      keys=[keys[i], keys[0]], interner=interner, results=[result], **kwargs)
+
+    def _merge_sequences(self):
+        """Merge sequences using diff data of differ.
+
+        :returns: iterator of elements of the merged sequence.
+        """
+        merger = merge.Merger()
+        merger.differ = self
+        merger.texts = self._sequences
+        return merger.merge_3_files()
+
+    def merge(self):
+        """Merge sequences and restore tab.
+
+        Merged elements are restored as they are produced, without
+        building the merged sequence. If one descendant equals the base,
+        the other descendant is restored as is.
+
+        :raises MergeError: if the merged song has no tracks.
+        """
+        assert len(self.songs) == 3
+        with timings.stage('merge'):
+            if self._keys[0] == self._keys[1]:
+                return flatten.restore(self._sequences[2])
+            if self._keys[2] == self._keys[1]:
+                return flatten.restore(self._sequences[0])
+            song = flatten.restore(self._merge_sequences())
+        if not song.tracks:
+            # Descendants removed different tracks, and Guitar Pro files
+            # can't be written without tracks
+            raise MergeError('descendants removed all tracks between them')
+        return song
+
+    def get_tracknumber(self, seq, index):
+        """Return number of the track that element at *index* of sequence
+        *seq* belongs to, or 0 if it's a song attribute."""
+        return bisect.bisect_left(self._track_starts[seq], index)
+
+    def store_change(self, sequence, pane, index, action, replace_prefix='!'):
+        prefix = dict(insert='+', delete='-', replace=replace_prefix, conflict='x', equal=' ')
+        obj = sequence[index]
+        if isinstance(obj, guitarpro.Measure):
+            measure = obj
+            track_number = measure.track.number + self.tracknumber[pane] - 1
+            self.measures.setdefault(measure.number - 1, {})[track_number] = prefix[action]
+        elif obj is guitarpro.Track:
+            if action == 'insert':
+                self.tracknumber[1 - pane] += 1
+
+    def print_info(self, seq, pane, index, action, replace_prefix='!'):
+        prefix = dict(insert='+', delete='-', replace=replace_prefix, conflict='x', equal=' ')
+        obj = self._sequences[seq][index]
+        if isinstance(obj, tuple):
+            attr, value = obj
+            number = self.get_tracknumber(seq, index)
+            str_value = format_value(attr, value)
+            if number > 0:
+                yield ("{prefix} Track {number}: {attr} = {value}"
+                       .format(prefix=prefix[action],
+                               number=number,
+                               attr=attr,
+                               value=str_value))
+            else:
+                yield ("{prefix} Song: {attr} = {value}"
+                       .format(prefix=prefix[action],
+                               attr=attr,
+                               value=str_value))
+
+    def describe(self, seq, index):
+        """Describe element at *index* of sequence *seq* as a dict."""
+        obj = self._sequences[seq][index]
+        if isinstance(obj, guitarpro.Measure):
+            return {'index': index, 'track': obj.track.number, 'measure': obj.number}
+        elif isinstance(obj, tuple):
+            attr, value = obj
+            return {'index': index, 'track': self.get_tracknumber(seq, index) or None,
+                    'attribute': attr, 'value': format_value(attr, value)}
+        else:
+            return {'index': index, 'object': obj.__name__}
+
+    def records(self):
+        """Yield a dict for every diff chunk.
+
+        Every record has the *pane* (0 for MYFILE, 1 for YOURFILE), the
+        *file* of the pane, the *tag* of the chunk, the *old* and *new*
+        ranges of the chunk with descriptions of elements in them, see
+        :meth:`describe`, and the *approximate* flag that tells if the diff
+        of the pane exceeded the cost limit and may not be the shortest.
+        """
+        for change in self.all_changes():
+            for pane in (0, 1):
+                if change[pane] is None:
+                    continue
+                tag, i1, i2, j1, j2 = change[pane]
+                yield {
+                    'pane': pane,
+                    'file': self.files[pane * 2],
+                    'tag': tag,
+                    'old': {'start': i1, 'end': i2,
+                            'elements': [self.describe(1, x) for x in range(i1, i2)]},
+                    'new': {'start': j1, 'end': j2,
+                            'elements': [self.describe(pane * 2, x) for x in range(j1, j2)]},
+                    'approximate': self._approximate[pane],
+                }
+
+    def show_json(self, ndjson=False):
+        """Output :meth:`records` as lines of a JSON array, or as
+        newline-delimited JSON if *ndjson* is True."""
+        return json_lines(self.records(), ndjson)
+
+    def infodiff(self, change, pane, replace_prefix='!'):
+        a, b = 1, pane * 2
+        tag, i1, i2, j1, j2 = change[pane]
+        if tag == 'replace':
+            for x in range(i1, i2):
+                yield from self.print_info(a, pane, x, 'delete')
+            for x in range(j1, j2):
+                yield from self.print_info(b, pane, x, 'insert')
+        if tag == 'delete':
+            for x in range(i1, i2):
+                yield from self.print_info(a, pane, x, 'delete')
+        if tag == 'insert':
+            for x in range(j1, j2):
+                yield from self.print_info(b, pane, x, 'insert')
+        if tag == 'conflict':
+            yield replace_prefix * 8
+            if i2 - i1 == 0:
+                for x in range(j1, j2):
+                    yield from self.print_info(b, pane, x, 'conflict')
+            else:
+                for x in range(i1, i2):
+                    yield from self.print_info(a, pane, x, 'conflict')
+
+    def measurediff(self, change, pane, replace_prefix='!'):
+        a, b = self._sequences[1], self._sequences[pane * 2]
+        tag, i1, i2, j1, j2 = change[pane]
+        if tag == 'replace':
+            if i2 - i1 == j2 - j1:
+                for x in range(i1, i2):
+                    self.store_change(a, pane, x, 'replace', replace_prefix)
+            elif i2 - i1 < j2 - j1:
+                for x in range(j1, j1 + i2 - i1):
+                    self.store_change(b, pane, x, 'replace', replace_prefix)
+                for x in range(j1 + i2 - i1, j2):
+                    self.store_change(b, pane, x, 'insert')
+            else:
+                for x in range(i1, i1 + j2 - j1):
+                    self.store_change(a, pane, x, 'replace', replace_prefix)
+                for x in range(i1 + j2 - j1, i2):
+                    self.store_change(a, pane, x, 'delete')
+        if tag == 'delete':
+            for x in range(i1, i2):
+                self.store_change(a, pane, x, 'delete')
+        if tag == 'insert':
+            for x in range(j1, j2):
+                self.store_change(b, pane, x, 'insert')
+        if tag == 'conflict':
+            if i2 - i1 == 0:
+                for x in range(j1, j2):
+                    self.store_change(b, pane, x, 'conflict')
+            else:
+                for x in range(i1, i2):
+                    self.store_change(a, pane, x, 'conflict')
+
+    def show(self):
+        """Output somewhat human-readable representation of diff between
+        sequences.
+
+        Changes are visited once: attribute changes are yielded right away,
+        and measure changes are collected into a sparse map that is printed
+        after them.
+        """
+        # Measure index -> track index -> change prefix
+        self.measures = {}
+        self.tracknumber = [0, 0]
+
+        if len(self.songs) == 3:
+            replace_prefix = '><'
+        else:
+            replace_prefix = '!!'
+
+        def getmtime(fn):
+            return time.ctime(os.path.getmtime(fn))
+
+        yield f'OLDFILE:  {self.files[1]}\t{getmtime(self.files[1])}'
+        yield f'MYFILE:   {self.files[0]}\t{getmtime(self.files[0])}'
+        if len(self.songs) > 2:
+            yield f'YOURFILE: {self.files[2]}\t{getmtime(self.files[2])}'
+        if self.approximate:
+            yield ''
+            yield 'Cost limit exceeded, the diff is approximate'
+
+        yield ''
+        yield 'Attributes'
+        yield '=========='
+        yield ''
+
+        for change in self.all_changes():
+            for pane in (0, 1):
+                if change[pane] is not None:
+                    yield from self.infodiff(change, pane, replace_prefix[pane])
+                    self.measurediff(change, pane, replace_prefix[pane])
+
+        yield ''
+        yield 'Measures'
+        yield '========'
+        yield ''
+
+        track_count = max(len(song.tracks) for song in self.songs)
+        measure_count = max((len(song.tracks[0].measures) for song in self.songs if song.tracks), default=0)
+        for tracks in self.measures.values():
+            track_count = max(track_count, max(tracks) + 1)
+
+        yield ' ' + ' '.join(str(i) for i in range(1, track_count + 1))
+        last = None
+        for number in sorted(self.measures):
+            if last is not None and number > last + 1:
+                yield ''
+            tracks = self.measures[number]
+            yield '[{}] {}'.format('|'.join(tracks.get(i, ' ') for i in range(track_count)),
+                                   number + 1)
+            last = number
+        if last is not None and last + 1 < measure_count:
+            yield ''
@@ -14,9 +14,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
+import collections
+
 import guitarpro
 
-from .myers import DiffChunk, MyersSequenceMatcher
+from . import timings
+from .myers import Chunks, DiffChunk, MyersSequenceMatcher
 
 
 opcode_reverse = {
@@ -28,10 +32,137 @@ opcode_reverse = {
 }
 
 
+def match(matcher, a, b):
+    """Compute difference opcodes between sequences *a* and *b*.
+
+    This is a module-level function so that it can be submitted to a
+    process pool.
+
+    Equal sequences, e.g. of files that differ only in what isn't
+    flattened, have no differences and aren't passed to *matcher*.
+
+    :returns: tuple (opcodes, approximate), where *approximate* tells if
+        the matcher gave up looking for the shortest diff.
+    """
+    with timings.stage('match', tokens=len(a) + len(b)) as metrics:
+        if a == b:
+            metrics['chunks'] = 0
+            return Chunks(), False
+        m = matcher(None, a, b)
+        m.initialise()
+        opcodes = m.get_difference_opcodes()
+        metrics['chunks'] = len(opcodes)
+        metrics['p'] = getattr(m, 'cost', None)
+    return opcodes, getattr(m, 'approximate', False)
+
+
+def estimate_cost(a, b):
+    """Estimate the work of matching sequences *a* and *b*.
+
+    The estimate is the total length of the sequences times the number of
+    elements that occur in one sequence more often than in the other, a
+    lower bound of the edit distance.
+    """
+    counts = collections.Counter(a)
+    counts.subtract(b)
+    return (len(a) + len(b)) * sum(map(abs, counts.values()))
+
+
+def opcodes_to_blocks(opcodes, len_a, len_b):
+    """Convert difference *opcodes* between sequences of lengths *len_a*
+    and *len_b* into matching blocks, including the sentinel."""
+    blocks = []
+    i = j = 0
+    for _, i1, i2, j1, j2 in opcodes:
+        if i1 > i:
+            blocks.append((i, j, i1 - i))
+        i, j = i2, j2
+    if len_a > i:
+        blocks.append((i, j, len_a - i))
+    blocks.append((len_a, len_b, 0))
+    return blocks
+
+
+def rematch(matcher, a, b, opcodes, start, removed, inserted, approximate=False, side=1):
+    """Update difference *opcodes* between *a* and *b* after *removed*
+    elements of *b* at index *start* were replaced by *inserted* elements,
+    or elements of *a* if *side* is 0.
+
+    *a* and *b* are the sequences after the change. Only the range between
+    the nearest matching blocks around the change is compared again. If
+    matchers made by *matcher* have a ``rematch(known_blocks, changed)``
+    method, it's given the matching blocks outside of the change and
+    tuple (side, lo, hi) of the changed range, and decides what to
+    compare again itself.
+
+    Approximate *opcodes* are not updated, *a* and *b* are matched again.
+
+    :param approximate: whether *opcodes* are approximate.
+    :returns: tuple (opcodes, approximate) as :func:`match`.
+    """
+    if approximate:
+        # It's unknown which part of the diff the matcher gave up on
+        return match(matcher, a, b)
+    end = start + removed
+    shift = inserted - removed
+    len_a = len(a)
+    if side == 0:
+        old_blocks = opcodes_to_blocks(opcodes, len_a - shift, len(b))[:-1]
+        old_blocks = [(j, i, n) for i, j, n in old_blocks]
+    else:
+        old_blocks = opcodes_to_blocks(opcodes, len_a, len(b) - shift)[:-1]
+    # Blocks are (other, changed, size) here
+    before, after = [], []
+    for i, j, n in old_blocks:
+        if j < start:
+            before.append((i, j, min(n, start - j)))
+        if j + n > end:
+            cut = max(0, end - j)
+            after.append((i + cut, j + cut + shift, n - cut))
+    if side == 0:
+        before = [(j, i, n) for i, j, n in before]
+        after = [(j, i, n) for i, j, n in after]
+
+    m = matcher(None, a, b)
+    if hasattr(m, 'rematch'):
+        return m.rematch(before + after, (side, start, start + inserted))
+
+    if before:
+        i, j, n = before[-1]
+        alo, blo = i + n, j + n
+    else:
+        alo = blo = 0
+    if after:
+        ahi, bhi, _ = after[0]
+    else:
+        ahi, bhi = len_a, len(b)
+    m = matcher(None, a[alo:ahi], b[blo:bhi])
+    window = [(alo + i, blo + j, n) for i, j, n in m.get_matching_blocks()[:-1]]
+
+    blocks = []
+    for i, j, n in before + window + after:
+        if blocks:
+            pi, pj, pn = blocks[-1]
+            if pi + pn == i and pj + pn == j:
+                blocks[-1] = (pi, pj, pn + n)
+                continue
+        blocks.append((i, j, n))
+    blocks.append((len_a, len(b), 0))
+    return Chunks.from_blocks(blocks), getattr(m, 'approximate', False)
+
+
 class Differ:
     """Utility class to hold diff2 or diff3 chunks"""
 
     _matcher = MyersSequenceMatcher
+    # concurrent.futures.Executor used to compute both diffs of a 3-way
+    # comparison in parallel, None to compute them one after another
+    executor = None
+    # Both diffs are sent to the executor only if :func:`estimate_cost` of
+    # each of them reaches this value, i.e. the matcher is expected to run
+    # for 50 ms or more. Cheaper diffs finish before the sequences reach
+    # the workers.
+    parallel_cost = 5 * 10 ** 6
 
     def __init__(self):
         # Internally, diffs are stored from text1 -> text0 and text1 -> text2.
@@ -42,15 +173,22 @@ class Differ:
         self._old_merge_cache = set()
         self._changed_chunks = tuple()
         self._merge_cache = []
-        self._line_cache = [[], [], []]
+        self._line_cache = [None, None, None]
         self._initialised = False
+        self.approximate = False
+        self._approximate = [False, False]
         self._has_mergeable_changes = (False, False, False, False)
 
-    def _update_merge_cache(self, texts):
+    def _update_merge_cache(self, texts, keys=None):
+        with timings.stage('merge_cache') as metrics:
+            self._compute_merge_cache(texts, keys)
+            metrics['chunks'] = len(self._merge_cache)
+            metrics['conflicts'] = len(self.conflicts)
+
+    def _compute_merge_cache(self, texts, keys=None):
         if self.num_sequences == 3:
-            self._merge_cache = [c for c in self._merge_diffs(self.diffs[0],
-                                                              self.diffs[1],
-                                                              texts)]
+            self._merge_cache = list(self._merge_diffs(self.diffs[0], self.diffs[1],
+                                                       texts, keys))
         else:
             self._merge_cache = [(c, None) for c in self.diffs[0]]
 
@@ -80,64 +218,93 @@ class Differ:
                (c2 is not None and c2.tag == 'conflict'):
                 self.conflicts.append(i)
 
-        self._update_line_cache()
+        self._line_cache = [None, None, None]
 
-    def _update_line_cache(self):
-        """Cache a mapping from line index to per-pane chunk indices
+    def _build_line_cache(self, seq):
+        """Build a mapping from line index of sequence *seq* to chunk indices
 
-        This cache exists so that the UI can quickly query for current,
-        next and previous chunks when the current cursor line changes,
-        enabling better action sensitivity feedback.
+        The mapping is stored as sorted, non-overlapping intervals of lines
+        that share the same (chunk, prev, next) tuple of merge cache indices.
         """
-        for i, l in enumerate(self.seqlength):
-            # seqlength + 1 for after-last-line requests, which we do
-            self._line_cache[i] = [(None, None, None)] * (l + 1)
-
+        with timings.stage('line_cache', pane=seq) as metrics:
+            line_cache = self._compute_line_cache(seq)
+            metrics['intervals'] = len(line_cache[0])
+        return line_cache
+
+    def _compute_line_cache(self, seq):
+        starts, ends, values = [], [], []
+
+        def paint(start, end, value):
+            if start >= end:
+                return
+            lo = bisect.bisect_right(ends, start)
+            hi = bisect.bisect_left(starts, end)
+            new_starts, new_ends, new_values = [start], [end], [value]
+            if lo < hi and starts[lo] < start:
+                new_starts.insert(0, starts[lo])
+                new_ends.insert(0, start)
+                new_values.insert(0, values[lo])
+            if lo < hi and ends[hi - 1] > end:
+                new_starts.append(end)
+                new_ends.append(ends[hi - 1])
+                new_values.append(values[hi - 1])
+            starts[lo:hi] = new_starts
+            ends[lo:hi] = new_ends
+            values[lo:hi] = new_values
+
+        # following[i] is the first chunk from i on that has a chunk in seq
+        diff = 1 if seq == 2 else 0
         last_chunk = len(self._merge_cache)
-
-        def find_next(diff, seq, current):
-            next_chunk = None
-            if seq == 1 and current + 1 < last_chunk:
-                next_chunk = current + 1
+        following = [None] * (last_chunk + 1)
+        for i in range(last_chunk - 1, -1, -1):
+            if seq == 1 or self._merge_cache[i][diff] is not None:
+                following[i] = i
             else:
-                for j in range(current + 1, last_chunk):
-                    if self._merge_cache[j][diff] is not None:
-                        next_chunk = j
-                        break
-            return next_chunk
-
-        prev = [None, None, None]
-        next = [find_next(0, 0, -1), find_next(0, 1, -1), find_next(1, 2, -1)]
-        old_end = [0, 0, 0]
+                following[i] = following[i + 1]
 
+        lo, hi = (1, 2) if seq == 1 else (3, 4)
+        prev, next, old_end = None, following[0], 0
         for i, c in enumerate(self._merge_cache):
-            seq_params = ((0, 0, 3, 4), (0, 1, 1, 2), (1, 2, 3, 4))
-            for (diff, seq, lo, hi) in seq_params:
-                if c[diff] is None:
-                    if seq == 1:
-                        diff = 1
-                    else:
-                        continue
-
-                start, end, last = c[diff][lo], c[diff][hi], old_end[seq]
-                if (start > last):
-                    chunk_ids = [(None, prev[seq], next[seq])] * (start - last)
-                    self._line_cache[seq][last:start] = chunk_ids
-
-                # For insert chunks, claim the subsequent line.
-                if start == end:
-                    end += 1
-
-                next[seq] = find_next(diff, seq, i)
-                chunk_ids = [(i, prev[seq], next[seq])] * (end - start)
-                self._line_cache[seq][start:end] = chunk_ids
-                prev[seq], old_end[seq] = i, end
-
-        for seq in range(3):
-            last, end = old_end[seq], len(self._line_cache[seq])
-            if (last < end):
-                chunk_ids = [(None, prev[seq], next[seq])] * (end - last)
-                self._line_cache[seq][last:end] = chunk_ids
+            chunk = c[diff]
+            if chunk is None:
+                if seq == 1:
+                    chunk = c[1]
+                else:
+                    continue
+
+            start, end = chunk[lo], chunk[hi]
+            paint(old_end, start, (None, prev, next))
+
+            # For insert chunks, claim the subsequent line.
+            if start == end:
+                end += 1
+
+            next = following[i + 1]
+            paint(start, end, (i, prev, next))
+            prev, old_end = i, end
+
+        # seqlength + 1 for after-last-line requests
+        paint(old_end, max(self.seqlength[seq] + 1, ends[-1] if ends else 0), (None, prev, next))
+        return starts, ends, values
+
+    def locate(self, pane, index):
+        """Find chunks around line *index* of sequence *pane*.
+
+        This exists so that the UI can quickly query for current, next and
+        previous chunks when the current cursor line changes, enabling
+        better action sensitivity feedback. The line cache is built on
+        first use after every change of diffs.
+
+        :returns: tuple (chunk, prev, next) of indices of merge cache
+            entries, where *chunk* is None if the line is not changed.
+        """
+        if self._line_cache[pane] is None:
+            self._line_cache[pane] = self._build_line_cache(pane)
+        starts, ends, values = self._line_cache[pane]
+        i = bisect.bisect_right(starts, index) - 1
+        if i < 0 or index >= ends[i]:
+            raise IndexError('line index out of range')
+        return values[i]
 
     def all_changes(self):
         return iter(self._merge_cache)
@@ -155,10 +322,12 @@ class Differ:
             high.append(highc - d[HI] + d[2 + HI])
         return low[0], high[0], lowc, highc, low[1], high[1]
 
-    def _auto_merge(self, using, texts):
+    def _auto_merge(self, using, texts, keys=None):
         """Automatically merge two sequences of change blocks"""
         l0, h0, l1, h1, l2, h2 = self._merge_blocks(using)
-        if h0 - l0 == h2 - l2 and texts[0][l0:h0] == texts[2][l2:h2]:
+        if keys is None:
+            keys = texts
+        if h0 - l0 == h2 - l2 and keys[0][l0:h0] == keys[2][l2:h2]:
             if l1 != h1 and l0 == h0:
                 tag = "delete"
             elif l1 != h1:
@@ -172,9 +341,9 @@ class Differ:
                 tag = "replace"
             else:
                 tag = "insert"
-            yield None, (tag, l1, h1, l2, h2)
+            yield None, DiffChunk(tag, l1, h1, l2, h2)
             if h2 - l2 < h0 - l0:
-                yield None, ('insert', l1, h1, l0 + (h2 - l2), h0)
+                yield None, DiffChunk('insert', l1, h1, l0 + (h2 - l2), h0)
             return
         elif all(isinstance(m, guitarpro.Measure) and m.isEmpty for m in texts[2][l2:h2]):
             if l1 != h1 and l0 == h0:
@@ -183,9 +352,9 @@ class Differ:
                 tag = "replace"
             else:
                 tag = "insert"
-            yield (tag, l1, h1, l0, h0), None
+            yield DiffChunk(tag, l1, h1, l0, h0), None
             if h0 - l0 < h2 - l2:
-                yield None, ('insert', l1, h1, l2 + (h0 - l0), h2)
+                yield None, DiffChunk('insert', l1, h1, l2 + (h0 - l0), h2)
             return
         else:
             tag = "conflict"
@@ -193,8 +362,8 @@ class Differ:
         out1 = DiffChunk._make((tag, l1, h1, l2, h2))
         yield out0, out1
 
-    def _merge_diffs(self, seq0, seq1, texts):
-        seq0, seq1 = seq0[:], seq1[:]
+    def _merge_diffs(self, seq0, seq1, texts, keys=None):
+        seq0, seq1 = collections.deque(seq0), collections.deque(seq1)
         seq = seq0, seq1
         while len(seq0) or len(seq1):
             if not seq0:
@@ -209,7 +378,7 @@ class Differ:
                     elif seq1[0].tag == "insert":
                         high_seq = 1
 
-            high_diff = seq[high_seq].pop(0)
+            high_diff = seq[high_seq].popleft()
             high_mark = high_diff.end_a
             other_seq = 0 if high_seq == 1 else 1
 
@@ -225,7 +394,7 @@ class Differ:
                     break
 
                 using[other_seq].append(other_diff)
-                seq[other_seq].pop(0)
+                seq[other_seq].popleft()
 
                 if high_mark < other_diff.end_a:
                     high_seq, other_seq = other_seq, high_seq
@@ -238,17 +407,100 @@ class Differ:
                 assert len(using[0]) == 1
                 yield using[0][0], None
             else:
-                yield from self._auto_merge(using, texts)
+                yield from self._auto_merge(using, texts, keys)
+
+    def set_sequences_iter(self, sequences, keys=None, results=None):
+        """Compute diffs between *sequences*.
 
-    def set_sequences_iter(self, sequences):
+        *keys* are optional sequences of the same lengths whose elements
+        are cheaper to compare than elements of *sequences*, e.g. tokens
+        produced by :class:`gpdiff.flatten.Interner`. The matcher runs on
+        keys while the merge cache keeps referring to *sequences*.
+
+        *results* are optional results of :func:`match` computed in
+        advance for every descendant.
+        """
         assert 0 <= len(sequences) <= 3
+        if keys is None:
+            keys = sequences
+        assert len(keys) == len(sequences)
         self.diffs = [[], []]
         self.num_sequences = len(sequences)
         self.seqlength = [len(s) for s in sequences]
-
-        for i in range(self.num_sequences - 1):
-            matcher = self._matcher(None, sequences[1], sequences[i * 2])
-            matcher.initialise()
-            self.diffs[i] = matcher.get_difference_opcodes()
+        self._texts = list(sequences)
+        self._keys = list(keys)
+
+        pairs = [(keys[1], keys[i * 2]) for i in range(self.num_sequences - 1)]
+        if results is not None:
+            assert len(results) == len(pairs)
+        elif (self.executor is not None and len(pairs) > 1
+              and min(estimate_cost(a, b) for a, b in pairs) >= self.parallel_cost):
+            futures = [self.executor.submit(match, self._matcher, a, b)
+                       for a, b in pairs]
+            results = [future.result() for future in futures]
+        else:
+            results = [match(self._matcher, a, b) for a, b in pairs]
+        self._approximate = [False, False]
+        for i, (diff, approximate) in enumerate(results):
+            self.diffs[i] = diff
+            self._approximate[i] = approximate
+        self.approximate = any(self._approximate)
         self._initialised = True
-        self._update_merge_cache(sequences)
+        self._update_merge_cache(sequences, keys)
+
+    def _keys_of(self, elements):
+        """Return keys of *elements* inserted by :meth:`change_sequence`.
+
+        Subclasses that pass *keys* to :meth:`set_sequences_iter` must
+        override this.
+        """
+        return elements
+
+    def _join_keys(self, sequence, keys):
+        """Return keys of changed *sequence* made of tuple *keys*.
+
+        Subclasses override this to keep the structure of keys that the
+        matcher relies on.
+        """
+        return keys
+
+    def change_sequence(self, pane, start, removed, inserted):
+        """Update diffs after *removed* elements of sequence *pane* at
+        index *start* were replaced by *inserted* elements.
+
+        Only the range between the nearest matching blocks around the
+        change is compared again, see :func:`rematch`.
+        """
+        assert self._initialised
+        assert 0 <= pane < self.num_sequences
+        end = start + removed
+        assert end <= self.seqlength[pane]
+
+        changed_chunks = tuple()
+        lo, hi = (1, 2) if pane == 1 else (3, 4)
+        for c in self._merge_cache:
+            chunk = c[1] if pane == 2 or c[0] is None else c[0]
+            if chunk is None or (pane == 0 and chunk is not c[0]):
+                continue
+            if chunk[lo] <= start <= chunk[hi]:
+                changed_chunks = c
+                break
+
+        text, keys = self._texts[pane], self._keys[pane]
+        self._texts[pane] = (*text[:start], *inserted, *text[end:])
+        self._keys[pane] = self._join_keys(self._texts[pane],
+                                           (*keys[:start], *self._keys_of(inserted), *keys[end:]))
+        self.seqlength[pane] = len(self._texts[pane])
+
+        for which in range(self.num_sequences - 1):
+            other = which * 2
+            if pane not in (1, other):
+                continue
+            self.diffs[which], self._approximate[which] = rematch(
+                self._matcher, self._keys[1], self._keys[other], self.diffs[which],
+                start, removed, len(inserted), self._approximate[which], side=0 if pane == 1 else 1)
+        self.approximate = any(self._approximate)
+
+        self._old_merge_cache = set(self._merge_cache)
+        self._changed_chunks = changed_chunks
+        self._update_merge_cache(self._texts, self._keys)
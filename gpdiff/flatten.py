@@ -1,100 +1,231 @@
-import copy
-
-import attr
-
-import guitarpro as gp
-
-
-def flatten(song):
-    """Convert Song into a tuple."""
-    result = []
-    result.extend(flat_obj(song, expand=['pageSetup'], skip=['tracks']))
-    for track in song.tracks:
-        result.extend(flat_obj(track, expand=['channel', 'settings'], skip=['measures']))
-        for measure in track.measures:
-            result.append(copy.copy(measure))
-    return tuple(result)
-
-
-def restore(sequence):
-    """Restore Song from flat sequence."""
-    song = None
-    stack = []
-    track_number = measure_number = 1
-    until = None
-    for e in sequence:
-        if stack:
-            top = stack[-1]
-        if e is gp.Song:
-            song = gp.Song(tracks=[], measureHeaders=[])
-            stack.append(song)
-        elif e is gp.PageSetup:
-            page_setup = gp.PageSetup()
-            song.pageSetup = page_setup
-            stack.append(page_setup)
-            until = len(attr.fields(gp.PageSetup))
-        elif e is gp.Track:
-            track = gp.Track(song, number=track_number, measures=[])
-            song.tracks.append(track)
-            stack.append(track)
-            track_number += 1
-            measure_number = 1
-        elif e is gp.MidiChannel:
-            channel = e()
-            track.channel = channel
-            stack.append(channel)
-            until = len(attr.fields(gp.MidiChannel))
-        elif e is gp.TrackSettings:
-            settings = e()
-            track.settings = settings
-            stack.append(settings)
-            until = len(attr.fields(gp.TrackSettings))
-        elif isinstance(e, gp.Measure):
-            e.track = top
-            e.number = measure_number
-            e.track.measures.append(e)
-            measure_number += 1
-        else:
-            attr_name, value = e
-            if isinstance(value, tuple):
-                value = list(value)
-            setattr(top, attr_name, value)
-            if until is not None:
-                if until > 1:
-                    until -= 1
-                else:
-                    until = None
-                    stack.pop()
-    return song
-
-
-def flat_obj(obj, expand=[], skip=[]):
-    """Convert *obj* into list consisting of *obj* class and *obj*
-    attributes in form of tuples.
-
-    >>> import guitarpro as gp
-    >>> note = gp.Note()
-    >>> flat_obj(note)
-    [<class 'guitarpro.models.Note'>,
-     ('value', 0), ('velocity', 95),
-     ('string', 1),
-     ('isTiedNote', False),
-     ('effect', NoteEffect(...)),
-     ('durationPercent', 1.0),
-     ('swapAccidentals', False)]
-    """
-    cls = type(obj)
-    yield cls
-    for attrib in attr.fields(cls):
-        if not attrib.eq:
-            continue
-        attr_name = attrib.name
-        if attr_name in skip:
-            continue
-        value = getattr(obj, attr_name)
-        if attr_name in expand:
-            yield from flat_obj(value)
-            continue
-        if isinstance(value, list):
-            value = tuple(value)
-        yield (attr_name, value)
+import bisect
+import collections.abc
+import copy
+import itertools
+
+import attr
+
+import guitarpro as gp
+
+
+def flatten(song, view=False):
+    """Convert Song into a tuple.
+
+    Measures are referenced in place, :func:`restore` copies them.
+
+    :param view: return lazy :class:`FlatSong` instead of a tuple.
+    """
+    flat = FlatSong(song)
+    if view:
+        return flat
+    return tuple(flat)
+
+
+class FlatSong(collections.abc.Sequence):
+    """Flat sequence of Song that references its measures in place.
+
+    Attributes of the song and its tracks are flattened in advance, and
+    measures are looked up in lists of measures of tracks on access.
+    """
+
+    def __init__(self, song):
+        self.song = song
+        self._parts = []
+        self._starts = []
+        length = 0
+        parts = [list(flat_obj(song, expand=['pageSetup'], skip=['tracks']))]
+        for track in song.tracks:
+            parts.append(list(flat_obj(track, expand=['channel', 'settings'], skip=['measures'])))
+            parts.append(track.measures)
+        for part in parts:
+            if part:
+                self._parts.append(part)
+                self._starts.append(length)
+                length += len(part)
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for part in self._parts:
+            yield from part
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step != 1:
+                return tuple(self[i] for i in range(start, stop, step))
+            result = []
+            part_index = bisect.bisect_right(self._starts, start) - 1
+            while start < stop:
+                part, part_start = self._parts[part_index], self._starts[part_index]
+                result.extend(part[start - part_start:stop - part_start])
+                start = part_start + len(part)
+                part_index += 1
+            return tuple(result)
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('FlatSong index out of range')
+        part_index = bisect.bisect_right(self._starts, index) - 1
+        return self._parts[part_index][index - self._starts[part_index]]
+
+
+def track_spans(sequence):
+    """Find tracks in flat *sequence*.
+
+    :returns: list of tuples (start, measures_start, end) for every track,
+        where *start* is the index of :class:`guitarpro.Track` marker,
+        *measures_start* is the index of the first measure of the track, and
+        *end* is the index past the last measure.
+    """
+    spans = []
+    start = measures_start = None
+    for i, e in enumerate(sequence):
+        if e is gp.Track:
+            if start is not None:
+                spans.append((start, measures_start or i, i))
+            start, measures_start = i, None
+        elif measures_start is None and start is not None and isinstance(e, gp.Measure):
+            measures_start = i
+    if start is not None:
+        spans.append((start, measures_start or len(sequence), len(sequence)))
+    return spans
+
+
+class Tokens(tuple):
+    """Tuple of tokens of a flattened song.
+
+    Tokens remember :func:`track_spans` of the sequence they were made of
+    in the :attr:`tracks` attribute.
+    """
+
+    def __new__(cls, tokens, tracks=()):
+        self = super().__new__(cls, tokens)
+        self.tracks = tracks
+        return self
+
+
+class Interner:
+    """Map flattened elements to integers.
+
+    Equal elements are mapped to equal tokens, so sequences of tokens can
+    be compared instead of comparing measures attribute by attribute.
+    Share one instance between all songs that are going to be compared.
+    Songs may be interned by several threads at once.
+
+    :param start: the smallest token to give to new elements.
+    """
+
+    def __init__(self, start=0):
+        self.table = {}
+        self._tokens = itertools.count(start)
+
+    @classmethod
+    def recover(cls, sequences, keys):
+        """Return interner that produced *keys* of flat *sequences*.
+
+        Elements the interner hasn't seen get tokens above all *keys*.
+        """
+        interner = cls(max((max(k) for k in keys if k), default=-1) + 1)
+        for sequence, k in zip(sequences, keys):
+            interner.table.update(zip(sequence, k))
+        return interner
+
+    def intern(self, sequence):
+        """Convert flat *sequence* into :class:`Tokens`."""
+        setdefault = self.table.setdefault
+        tokens = self._tokens
+        return Tokens((setdefault(e, next(tokens)) for e in sequence), track_spans(sequence))
+
+
+def restore(sequence):
+    """Restore Song from flat sequence.
+
+    *sequence* may be any iterable, e.g. a stream of merged elements.
+    """
+    song = None
+    stack = []
+    track_number = measure_number = 1
+    until = None
+    for e in sequence:
+        if stack:
+            top = stack[-1]
+        if e is gp.Song:
+            song = gp.Song(tracks=[], measureHeaders=[])
+            stack.append(song)
+        elif e is gp.PageSetup:
+            page_setup = gp.PageSetup()
+            song.pageSetup = page_setup
+            stack.append(page_setup)
+            until = len(attr.fields(gp.PageSetup))
+        elif e is gp.Track:
+            track = gp.Track(song, number=track_number, measures=[])
+            song.tracks.append(track)
+            stack.append(track)
+            track_number += 1
+            measure_number = 1
+        elif e is gp.MidiChannel:
+            channel = e()
+            track.channel = channel
+            stack.append(channel)
+            until = len(attr.fields(gp.MidiChannel))
+        elif e is gp.TrackSettings:
+            settings = e()
+            track.settings = settings
+            stack.append(settings)
+            until = len(attr.fields(gp.TrackSettings))
+        elif isinstance(e, gp.Measure):
+            # Measures may belong to the songs that were flattened
+            measure = copy.copy(e)
+            measure.track = top
+            if measure.number != measure_number:
+                measure.header = copy.copy(measure.header)
+                measure.number = measure_number
+            top.measures.append(measure)
+            measure_number += 1
+        else:
+            attr_name, value = e
+            if isinstance(value, tuple):
+                value = list(value)
+            setattr(top, attr_name, value)
+            if until is not None:
+                if until > 1:
+                    until -= 1
+                else:
+                    until = None
+                    stack.pop()
+    return song
+
+
+def flat_obj(obj, expand=[], skip=[]):
+    """Convert *obj* into list consisting of *obj* class and *obj*
+    attributes in form of tuples.
+
+    >>> import guitarpro as gp
+    >>> note = gp.Note()
+    >>> flat_obj(note)
+    [<class 'guitarpro.models.Note'>,
+     ('value', 0), ('velocity', 95),
+     ('string', 1),
+     ('isTiedNote', False),
+     ('effect', NoteEffect(...)),
+     ('durationPercent', 1.0),
+     ('swapAccidentals', False)]
+    """
+    cls = type(obj)
+    yield cls
+    for attrib in attr.fields(cls):
+        if not attrib.eq:
+            continue
+        attr_name = attrib.name
+        if attr_name in skip:
+            continue
+        value = getattr(obj, attr_name)
+        if attr_name in expand:
+            yield from flat_obj(value)
+            continue
+        if isinstance(value, list):
+            value = tuple(value)
+        yield (attr_name, value)
@@ -1,14 +1,31 @@
 import argparse
+import contextlib
+import filecmp
+import functools
+import json
 import os
+import shutil
 import sys
-import time
+import tracemalloc
 
-import attr
-import guitarpro
+from . import __version__
+from . import timings
 
-from . import flatten
-from . import diffutil
-from . import merge
+# Modules that import guitarpro, attr and the diff algorithms are imported
+# on demand, so that --help, --version and requests to a server don't pay
+# for them.  Names that used to live here are forwarded to
+# :mod:`gpdiff.differ` by :func:`__getattr__`.
+_differ_names = ('GPDiffer', 'batch_report', 'diff_files', 'execute', 'format_value', 'load',
+                 'make_matcher', 'matchers', 'report')
+
+
+def __getattr__(name):
+    if name == 'parser':
+        return make_parser()
+    if name in _differ_names:
+        from . import differ
+        return getattr(differ, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def main():
@@ -17,25 +34,169 @@ def main():
 
 def cli(argv):
     """Command line interface."""
-    args = parser.parse_args(argv)
-    files = [args.MYFILE, args.OLDFILE, args.YOURFILE]
-    # Parse files
-    songs = [guitarpro.parse(f) for f in files if f is not None]
-    differ = GPDiffer(files, songs)
-    if len(files) == 3:
-        # If output is specified, try to merge
+    args = make_parser().parse_args(argv)
+    recorder = None
+    if args.timings:
+        recorder = timings.Recorder()
+        timings.add_hook(recorder)
+        tracemalloc.start()
+    try:
+        if args.profile is not None:
+            import cProfile
+
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(run, args)
+            finally:
+                profiler.dump_stats(args.profile)
+        return run(args)
+    finally:
+        if recorder is not None:
+            tracemalloc.stop()
+            timings.remove_hook(recorder)
+            for line in recorder.report():
+                print(line, file=sys.stderr)
+
+
+def run(args):
+    """Run command with parsed command line *args*."""
+    parser = make_parser()
+    if os.path.isdir(args.OLDFILE) and os.path.isdir(args.MYFILE):
+        if args.YOURFILE or args.batch or args.output is not None:
+            parser.error('directories can only be compared with each other')
+        if args.format == 'json':
+            parser.error('argument -f/--format: json is not supported for directories, use ndjson')
+        if args.connect is not None:
+            parser.error('argument --connect: not allowed for directories')
+        return cli_tree(args)
+    if args.batch:
         if args.output is not None:
-            result = differ.merge()
-            max_version = max(song.versionTuple for song in songs)
-            guitarpro.write(result, args.output, version=max_version)
-            if not len(differ.conflicts):
-                return 0
-    for line in differ.show():
-        print(line)
-    if len(files) == 2 or not differ.conflicts:
+            parser.error('argument -o: not allowed in batch mode')
+        files = [args.OLDFILE, args.MYFILE] + args.YOURFILE
+    elif len(args.YOURFILE) > 1:
+        parser.error('too many files, use --batch to diff OLDFILE against each of them')
+    else:
+        files = [args.MYFILE, args.OLDFILE] + args.YOURFILE
+    if not args.batch:
+        status = shortcut(args, files)
+        if status is not None:
+            return status
+    if args.connect is not None:
+        return connect(args, files)
+    from .differ import MergeError, execute, load
+
+    options = dict(algorithm=args.algorithm, max_cost=args.max_cost)
+    with create_executor(args.executor, args.jobs) as executor:
+        songs, sequences = load(files)
+        try:
+            status, lines = execute(files, songs, sequences, args.format, args.output, args.batch,
+                                    executor, **options)
+        except MergeError as exc:
+            parser.exit(2, f'{parser.prog}: error: {exc}\n')
+        with timings.stage('report', format=args.format):
+            for line in lines:
+                print(line)
+    return status
+
+
+def shortcut(args, files):
+    """Compare contents of *files* without parsing them.
+
+    Identical files have no differences, and a merge where one descendant
+    is identical to the base is the other descendant.
+
+    :param files: list of file names: [A, O] or [A, O, B].
+    :returns: exit status, or None if the files need to be parsed.
+    """
+    mine, old = files[:2]
+    if len(files) == 2:
+        if not filecmp.cmp(mine, old, shallow=False):
+            return None
+        if args.format == 'json':
+            print(json.dumps([]))
         return 0
+    if args.output is None:
+        return None
+    yours = files[2]
+    if filecmp.cmp(mine, old, shallow=False):
+        source = yours
+    elif filecmp.cmp(yours, old, shallow=False):
+        source = mine
     else:
-        return 1
+        return None
+    if not (os.path.exists(args.output) and os.path.samefile(source, args.output)):
+        shutil.copyfile(source, args.output)
+    if args.format == 'json':
+        print(json.dumps([]))
+    return 0
+
+
+def connect(args, files):
+    """Send files to diff to the server listening on socket *args.connect*
+    and print the report it returns."""
+    from . import client
+
+    parser = make_parser()
+    request = {
+        'files': [os.path.abspath(path) for path in files],
+        'format': args.format,
+        'output': os.path.abspath(args.output) if args.output is not None else None,
+        'batch': args.batch,
+        'algorithm': args.algorithm,
+        'max_cost': args.max_cost,
+    }
+    try:
+        response = client.request(args.connect, request)
+    except OSError as exc:
+        parser.exit(2, f'{parser.prog}: error: cannot connect to {args.connect}: {exc}\n')
+    if 'error' in response:
+        print(f'{parser.prog}: error: {response["error"]}', file=sys.stderr)
+    for line in response.get('output', []):
+        print(line)
+    return response['status']
+
+
+def cli_tree(args):
+    """Compare directories OLDFILE and MYFILE."""
+    from . import tree
+    from .differ import diff_files
+
+    diff = functools.partial(diff_files, fmt=args.format, algorithm=args.algorithm, max_cost=args.max_cost)
+    statuses = []
+    with create_executor(args.executor, args.jobs) as executor:
+        for path, status, lines in tree.diff_trees(args.OLDFILE, args.MYFILE, diff, executor):
+            statuses.append(status)
+            if args.format == 'ndjson':
+                print(json.dumps({'path': path, 'status': status}))
+                for line in lines:
+                    print(line)
+                continue
+            if status == 'removed':
+                print(f'Only in {args.OLDFILE}: {path}')
+            elif status == 'added':
+                print(f'Only in {args.MYFILE}: {path}')
+            elif status == 'changed':
+                print(f'diff {os.path.join(args.OLDFILE, path)} {os.path.join(args.MYFILE, path)}')
+                for line in lines:
+                    print(line)
+                print()
+    if args.format == 'text':
+        print(tree.summarize(statuses))
+    return 0
+
+
+def create_executor(kind, jobs):
+    """Return a context manager with an executor of given *kind* running
+    *jobs* workers, or with None if there's only one job."""
+    if jobs <= 1:
+        return contextlib.nullcontext()
+
+    from concurrent import futures
+
+    if kind == 'thread':
+        return futures.ThreadPoolExecutor(jobs)
+    else:
+        return futures.ProcessPoolExecutor(jobs)
 
 
 legend = ('Measure diff legend:\n'
@@ -45,208 +206,48 @@ legend = ('Measure diff legend:\n'
           '  >  changed measure of first descendant\n'
           '  <  changed measure of second descendant\n'
           '  x  conflict')
-parser = argparse.ArgumentParser(
-    formatter_class=argparse.RawDescriptionHelpFormatter,
-    description='Diff and merge Guitar Pro 3-5 files\n\n' + legend,
-    epilog='Returns 0 if diff or merge completed without conflicts\n'
-           'Returns 1 if conflicts occurred\n'
-           'Returns 2 if error occurred')
-parser.add_argument('OLDFILE')
-parser.add_argument('MYFILE')
-parser.add_argument('YOURFILE', nargs='?')
-parser.add_argument('-o', dest='output', metavar='OUTPUT', help='path to output merged file')
-
-
-@attr.s
-class GPDiffer(diffutil.Differ):
-    """A Differ instance with given songs.
-
-    :param files: list of 2 or 3 file names: [A, O, B] or [A, O].
-    :param songs: list of 2 or 3 parsed tabs.
-    """
-    files = attr.ib(default=attr.Factory(list))
-    songs = attr.ib(default=attr.Factory(list))
-
-    def __attrs_post_init__(self):
-        super().__init__()
-        self.files = self.files[:]
-        self.songs = self.songs[:]
-        self._sequences = list(map(flatten.flatten, self.songs))
-        self.set_sequences_iter(self._sequences)
-
-    def _merge_sequences(self):
-        """Merge sequences using diff data of differ."""
-        merger = merge.Merger()
-        merger.differ = self
-        merger.texts = self._sequences
-        return merger.merge_3_files()
-
-    def merge(self):
-        """Merge sequences and restore tab."""
-        assert len(self.songs) == 3
-        merged_sequence = self._merge_sequences()
-        return flatten.restore(merged_sequence)
-
-    def get_tracknumber(self, sequence):
-        tracks = [x for x in sequence if x is guitarpro.Track]
-        return len(tracks)
-
-    def store_change(self, sequence, pane, index, action, replace_prefix='!'):
-        prefix = dict(insert='+', delete='-', replace=replace_prefix, conflict='x', equal=' ')
-        obj = sequence[index]
-        if isinstance(obj, guitarpro.Measure):
-            measure = obj
-            track_number = measure.track.number + self.tracknumber[pane] - 1
-            self.measures[track_number][measure.number - 1] = prefix[action]
-        elif obj is guitarpro.Track:
-            if action == 'insert':
-                self.tracknumber[1 - pane] += 1
-
-    def print_info(self, sequence, pane, index, action, replace_prefix='!'):
-        prefix = dict(insert='+', delete='-', replace=replace_prefix, conflict='x', equal=' ')
-        obj = sequence[index]
-        if isinstance(obj, tuple):
-            attr, value = obj
-            number = self.get_tracknumber(sequence[:index])
-            if isinstance(value, tuple):
-                if attr == 'strings':
-                    value = reversed(value)
-                    str_value = '({})'.format(', '.join(map(str, value)))
-                else:
-                    str_value = str(value)
-            elif isinstance(value, str):
-                str_value = repr(value)
-            elif isinstance(value, guitarpro.Lyrics):
-                str_value = repr(str(value))
-            else:
-                str_value = str(value)
-            if number > 0:
-                yield ("{prefix} Track {number}: {attr} = {value}"
-                       .format(prefix=prefix[action],
-                               number=number + self.tracknumber[pane],
-                               attr=attr,
-                               value=str_value))
-            else:
-                yield ("{prefix} Song: {attr} = {value}"
-                       .format(prefix=prefix[action],
-                               attr=attr,
-                               value=str_value))
-
-    def infodiff(self, change, pane, replace_prefix='!'):
-        a, b = self._sequences[1], self._sequences[pane * 2]
-        tag, i1, i2, j1, j2 = change[pane]
-        if tag == 'replace':
-            for x in range(i1, i2):
-                yield from self.print_info(a, pane, x, 'delete')
-            for x in range(j1, j2):
-                yield from self.print_info(b, pane, x, 'insert')
-        if tag == 'delete':
-            for x in range(i1, i2):
-                yield from self.print_info(a, pane, x, 'delete')
-        if tag == 'insert':
-            for x in range(j1, j2):
-                yield from self.print_info(b, pane, x, 'insert')
-        if tag == 'conflict':
-            yield replace_prefix * 8
-            if i2 - i1 == 0:
-                for x in range(j1, j2):
-                    yield from self.print_info(b, pane, x, 'conflict')
-            else:
-                for x in range(i1, i2):
-                    yield from self.print_info(a, pane, x, 'conflict')
-
-    def measurediff(self, change, pane, replace_prefix='!'):
-        a, b = self._sequences[1], self._sequences[pane * 2]
-        tag, i1, i2, j1, j2 = change[pane]
-        if tag == 'replace':
-            if i2 - i1 == j2 - j1:
-                for x in range(i1, i2):
-                    self.store_change(a, pane, x, 'replace', replace_prefix)
-            elif i2 - i1 < j2 - j1:
-                for x in range(j1, j1 + i2 - i1):
-                    self.store_change(b, pane, x, 'replace', replace_prefix)
-                for x in range(j1 + i2 - i1, j2):
-                    self.store_change(b, pane, x, 'insert')
-            else:
-                for x in range(i1, i1 + j2 - j1):
-                    self.store_change(a, pane, x, 'replace', replace_prefix)
-                for x in range(i1 + j2 - j1, i2):
-                    self.store_change(a, pane, x, 'delete')
-        if tag == 'delete':
-            for x in range(i1, i2):
-                self.store_change(a, pane, x, 'delete')
-        if tag == 'insert':
-            for x in range(j1, j2):
-                self.store_change(b, pane, x, 'insert')
-        if tag == 'conflict':
-            if i2 - i1 == 0:
-                for x in range(j1, j2):
-                    self.store_change(b, pane, x, 'conflict')
-            else:
-                for x in range(i1, i2):
-                    self.store_change(a, pane, x, 'conflict')
-
-    def show(self):
-        """Output somewhat human-readable representation of diff between
-        sequences."""
-        self.measures = []
-        self.tracknumber = [0, 0]
-        for i in range(max(len(song.tracks) for song in self.songs)):
-            track = []
-            for j in range(max(len(song.tracks[0].measures) for song in self.songs)):
-                track.append(' ')
-            self.measures.append(track)
-
-        if len(self.songs) == 3:
-            replace_prefix = '><'
-        else:
-            replace_prefix = '!!'
-
-        # for change in self.all_changes():
-        #     yield change
-
-        def getmtime(fn):
-            return time.ctime(os.path.getmtime(fn))
-
-        yield f'OLDFILE:  {self.files[1]}\t{getmtime(self.files[1])}'
-        yield f'MYFILE:   {self.files[0]}\t{getmtime(self.files[0])}'
-        if len(self.songs) > 2:
-            yield f'YOURFILE: {self.files[2]}\t{getmtime(self.files[2])}'
-
-        yield ''
-        yield 'Attributes'
-        yield '=========='
-        yield ''
-
-        for change in self.all_changes():
-            if change[0] is not None:
-                yield from self.infodiff(change, 0, replace_prefix[0])
-            if change[1] is not None:
-                yield from self.infodiff(change, 1, replace_prefix[1])
-
-        yield ''
-        yield 'Measures'
-        yield '========'
-        yield ''
-
-        for change in self.all_changes():
-            if change[0] is not None:
-                self.measurediff(change, 0, replace_prefix[0])
-            if change[1] is not None:
-                self.measurediff(change, 1, replace_prefix[1])
-
-        block = False
-
-        yield ' ' + ' '.join([str(i) for i, _ in enumerate(self.measures, start=1)])
-        for number, tracks in enumerate(zip(*self.measures)):
-            if any(x != ' ' for x in tracks):
-                yield '[{}] {}'.format('|'.join(map(str, tracks)),
-                                       number + 1)
-                block = True
-            else:
-                if block:
-                    yield ''
-                block = False
+
+algorithms = ('linear', 'myers', 'patience')
+
+
+@functools.lru_cache(maxsize=None)
+def make_parser():
+    """Return the parser of command line arguments."""
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='Diff and merge Guitar Pro 3-5 files\n\n'
+                    'If OLDFILE and MYFILE are directories, Guitar Pro files in them\n'
+                    'are paired by path and compared, skipping identical files.\n\n' + legend,
+        epilog='Returns 0 if diff or merge completed without conflicts\n'
+               'Returns 1 if conflicts occurred\n'
+               'Returns 2 if error occurred')
+    parser.add_argument('OLDFILE')
+    parser.add_argument('MYFILE')
+    parser.add_argument('YOURFILE', nargs='*')
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='diff OLDFILE against MYFILE and each YOURFILE separately')
+    parser.add_argument('-o', dest='output', metavar='OUTPUT', help='path to output merged file')
+    parser.add_argument('-f', '--format', choices=['text', 'json', 'ndjson'], default='text',
+                        help='output format of the diff (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of workers to compute large diffs and to compare directories in parallel; '
+                             'files are parsed one after another (default: %(default)s)')
+    parser.add_argument('--executor', choices=['process', 'thread'], default='process',
+                        help='kind of workers used when JOBS is greater than 1 (default: %(default)s)')
+    parser.add_argument('-a', '--algorithm', choices=algorithms, default='myers',
+                        help='diff algorithm used to compare song attributes and tracks (default: %(default)s)')
+    parser.add_argument('--max-cost', type=int, metavar='COST',
+                        help='give up looking for the shortest diff after exploring COST deletions, '
+                             'and fall back to a faster approximate diff')
+    parser.add_argument('--timings', action='store_true',
+                        help='print wall time, sizes and peak memory of every stage to stderr; '
+                             'tracing memory slows gpdiff down')
+    parser.add_argument('--profile', metavar='FILE', help='write cProfile statistics of the run to FILE')
+    parser.add_argument('--connect', metavar='SOCKET',
+                        help='send files to gpdiff-server listening on Unix socket SOCKET '
+                             'instead of diffing them here')
+    parser.add_argument('--version', action='version', version=f'%(prog)s {__version__}')
+    return parser
 
 
 if __name__ == '__main__':
@@ -0,0 +1,156 @@
+import attr
+
+from .diffutil import Differ, estimate_cost
+from .myers import MyersSequenceMatcher
+
+
+def match_blocks(matcher, a, b):
+    """Compare a pair of tracks *a* and *b* with a new instance of
+    *matcher*, in this process or in a worker.
+
+    :returns: tuple (blocks without the sentinel, approximate, cost).
+    """
+    m = matcher(None, a, b)
+    return m.get_matching_blocks()[:-1], getattr(m, 'approximate', False), getattr(m, 'cost', 0)
+
+
+def clip_blocks(blocks, lo, hi, side):
+    """Return parts of matching *blocks* that lie in range [lo, hi) of
+    sequence a if *side* is 0, or of sequence b if *side* is 1."""
+    clipped = []
+    for block in blocks:
+        i, j, n = block
+        start = block[side]
+        first, last = max(lo, start), min(hi, start + n)
+        if first < last:
+            clipped.append((i + first - start, j + first - start, last - first))
+    return clipped
+
+
+@attr.s
+class HierarchicalMatcher(MyersSequenceMatcher):
+    """Two-level matcher of flattened songs.
+
+    Tracks are aligned by their attribute blocks first, then every pair of
+    aligned tracks is compared by *submatcher* independently, so the cost
+    of the diff depends on the size of changed tracks rather than on the
+    size of the whole song. Falls back to *submatcher* if *a* or *b* are
+    not :class:`gpdiff.flatten.Tokens`.
+
+    :param submatcher: matcher class to compare song attributes and pairs
+        of tracks.
+    :param executor: optional executor to compare expensive pairs of
+        tracks in parallel.
+    """
+
+    # Pairs of tracks are sent to the executor only if
+    # :func:`gpdiff.diffutil.estimate_cost` of the pair reaches this value,
+    # cheaper pairs are compared faster than they reach the workers
+    parallel_cost = Differ.parallel_cost
+
+    submatcher = attr.ib(default=MyersSequenceMatcher)
+    executor = attr.ib(default=None)
+
+    def __attrs_post_init__(self):
+        self.a_tracks = getattr(self.a, 'tracks', None)
+        self.b_tracks = getattr(self.b, 'tracks', None)
+        self.known_blocks = self.changed = None
+        self.reused = 0
+        super().__attrs_post_init__()
+
+    def rematch(self, known_blocks, changed):
+        """Compute difference opcodes after a part of *a* or *b* changed,
+        see :func:`gpdiff.diffutil.rematch`.
+
+        Tracks are aligned again. Pairs of tracks outside of the *changed*
+        range keep their *known_blocks* instead of being compared again, as
+        long as the blocks don't cross the pair. The number of such pairs
+        is stored in :attr:`reused`.
+
+        :param known_blocks: matching blocks of a previous diff that are
+            still valid outside of the *changed* range.
+        :param changed: tuple (side, lo, hi) of the range of *b* that
+            changed since the previous diff, or of *a* if *side* is 0.
+        :returns: tuple (opcodes, approximate).
+        """
+        self.known_blocks = known_blocks
+        self.changed = changed
+        self.matching_blocks = None
+        return self.get_difference_opcodes(), self.approximate
+
+    def align_tracks(self):
+        """Return list of ranges (alo, ahi, blo, bhi) of aligned tracks.
+
+        Tracks with equal attributes are aligned with each other, tracks
+        that replace one another are aligned in order.
+        """
+        table = {}
+        a_keys = [table.setdefault(self.a[start:measures_start], len(table))
+                  for start, measures_start, _ in self.a_tracks]
+        b_keys = [table.setdefault(self.b[start:measures_start], len(table))
+                  for start, measures_start, _ in self.b_tracks]
+        pairs = []
+        matcher = self.submatcher(None, a_keys, b_keys)
+        opcodes = matcher.get_opcodes()
+        self.approximate = getattr(matcher, 'approximate', False)
+        self.cost = getattr(matcher, 'cost', 0)
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag not in ('equal', 'replace'):
+                continue
+            for i, j in zip(range(i1, i2), range(j1, j2)):
+                alo, _, ahi = self.a_tracks[i]
+                blo, _, bhi = self.b_tracks[j]
+                pairs.append((alo, ahi, blo, bhi))
+        return pairs
+
+    def reuse_blocks(self, alo, ahi, blo, bhi):
+        """Return result of :func:`match_blocks` for range a[alo:ahi] and
+        b[blo:bhi] taken from :attr:`known_blocks`, or None if the range
+        has to be compared again."""
+        if self.known_blocks is None:
+            return None
+        side, lo, hi = self.changed
+        first, last = (alo, ahi) if side == 0 else (blo, bhi)
+        if lo <= last and first <= hi:
+            return None
+        blocks = clip_blocks(self.known_blocks, blo, bhi, 1)
+        # The pair may have been aligned differently before
+        if not blocks or blocks != clip_blocks(self.known_blocks, alo, ahi, 0):
+            return None
+        return [(i - alo, j - blo, n) for i, j, n in blocks], False, 0
+
+    def initialise(self):
+        if self.a_tracks and self.b_tracks:
+            ranges = [(0, self.a_tracks[0][0], 0, self.b_tracks[0][0])]
+            ranges.extend(self.align_tracks())
+        else:
+            ranges = [(0, len(self.a), 0, len(self.b))]
+        results = [self.reuse_blocks(*r) for r in ranges]
+        self.reused = sum(result is not None for result in results)
+        pairs = {k: (self.a[ranges[k][0]:ranges[k][1]], self.b[ranges[k][2]:ranges[k][3]])
+                 for k, result in enumerate(results) if result is None}
+        submitted = {}
+        if self.executor is not None:
+            for k, (a, b) in pairs.items():
+                if estimate_cost(a, b) >= self.parallel_cost:
+                    submitted[k] = self.executor.submit(match_blocks, self.submatcher, a, b)
+        for k, (a, b) in pairs.items():
+            if k not in submitted:
+                results[k] = match_blocks(self.submatcher, a, b)
+        for k, future in submitted.items():
+            results[k] = future.result()
+
+        self.matching_blocks = matching_blocks = []
+        for (alo, _, blo, _), (blocks, approximate, cost) in zip(ranges, results):
+            self.approximate = self.approximate or approximate
+            self.cost = max(self.cost, cost)
+            for i, j, n in blocks:
+                i += alo
+                j += blo
+                if matching_blocks:
+                    pi, pj, pn = matching_blocks[-1]
+                    if pi + pn == i and pj + pn == j:
+                        matching_blocks[-1] = (pi, pj, pn + n)
+                        continue
+                matching_blocks.append((i, j, n))
+        matching_blocks.append((len(self.a), len(self.b), 0))
@@ -23,25 +23,25 @@ class Merger(diffutil.Differ):
         self.differ.unresolved = []
         self.texts = []
 
-    def _apply_change(self, text, change, mergedtext):
+    def _apply_change(self, text, change):
         LO, HI = 1, 2
         if change[0] == 'insert':
             for i in range(change[LO + 2], change[HI + 2]):
-                mergedtext.append(text[i])
+                yield text[i]
             return 0
         elif change[0] == 'replace':
             for i in range(change[LO + 2], change[HI + 2]):
-                mergedtext.append(text[i])
+                yield text[i]
             return change[HI] - change[LO]
         else:
             return change[HI] - change[LO]
 
     def merge_3_files(self):
+        """Yield elements of the merged text one by one."""
         LO, HI = 1, 2
         self.unresolved = []
         lastline = 0
         mergedline = 0
-        mergedtext = []
         for change in self.differ.all_changes():
             low_mark = lastline
             if change[0] is not None:
@@ -50,17 +50,15 @@ class Merger(diffutil.Differ):
                 if change[1][LO] > low_mark:
                     low_mark = change[1][LO]
             for i in range(lastline, low_mark, 1):
-                mergedtext.append(self.texts[1][i])
+                yield self.texts[1][i]
             mergedline += low_mark - lastline
             lastline = low_mark
             if change[0] is not None:
-                lastline += self._apply_change(self.texts[0], change[0], mergedtext)
+                lastline += yield from self._apply_change(self.texts[0], change[0])
                 mergedline += change[0][HI + 2] - change[0][LO + 2]
             else:
-                lastline += self._apply_change(self.texts[2], change[1], mergedtext)
+                lastline += yield from self._apply_change(self.texts[2], change[1])
                 mergedline += change[1][HI + 2] - change[1][LO + 2]
         baselen = len(self.texts[1])
         for i in range(lastline, baselen, 1):
-            mergedtext.append(self.texts[1][i])
-
-        return mergedtext
+            yield self.texts[1][i]
@@ -13,7 +13,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import array
+import bisect
 import collections
+import collections.abc
 import difflib
 
 import attr
@@ -55,16 +58,194 @@ def find_common_suffix(a, b):
     return 0
 
 
+def trim_range(a, alo, ahi, b, blo, bhi, blocks):
+    """Remove common prefix and suffix of ranges a[alo:ahi] and
+    b[blo:bhi], and add them to *blocks*.
+
+    :returns: trimmed ranges (alo, ahi, blo, bhi).
+    """
+    start = alo
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        alo += 1
+        blo += 1
+    if alo > start:
+        blocks.append((start, blo - (alo - start), alo - start))
+    end = ahi
+    while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+    if ahi < end:
+        blocks.append((ahi, bhi, end - ahi))
+    return alo, ahi, blo, bhi
+
+
+def unique_anchors(a, alo, ahi, b, blo, bhi):
+    """Find elements that occur exactly once in both a[alo:ahi] and
+    b[blo:bhi], and select the longest sequence of them that appears in the
+    same order in both ranges, as in patience diff.
+
+    :returns: list of pairs (i, j) such that a[i] == b[j].
+    """
+    counts = {}
+    for i in range(alo, ahi):
+        entry = counts.get(a[i])
+        if entry is None:
+            counts[a[i]] = [1, i, 0, -1]
+        else:
+            entry[0] += 1
+    for j in range(blo, bhi):
+        entry = counts.get(b[j])
+        if entry is not None:
+            entry[2] += 1
+            entry[3] = j
+    candidates = sorted((i, j) for count_a, i, count_b, j in counts.values()
+                        if count_a == count_b == 1)
+    return longest_increasing(candidates)
+
+
+def longest_increasing(pairs):
+    """Select the longest subsequence of *pairs* sorted by the first item
+    that is also increasing by the second item, using patience sorting."""
+    tails = []
+    tail_indices = []
+    backpointers = []
+    for index, (_, j) in enumerate(pairs):
+        pile = bisect.bisect_left(tails, j)
+        if pile == len(tails):
+            tails.append(j)
+            tail_indices.append(index)
+        else:
+            tails[pile] = j
+            tail_indices[pile] = index
+        backpointers.append(tail_indices[pile - 1] if pile > 0 else None)
+    result = []
+    index = tail_indices[-1] if tail_indices else None
+    while index is not None:
+        result.append(pairs[index])
+        index = backpointers[index]
+    result.reverse()
+    return result
+
+
+def anchor_snakes(a, b):
+    """Align *a* and *b* cheaply around unique anchors.
+
+    Every anchor is extended backward and forward over equal elements. The
+    result is not guaranteed to be the longest common subsequence.
+
+    :returns: list of snakes (x, y, length).
+    """
+    snakes = []
+    last_x = last_y = 0
+    for x, y in unique_anchors(a, 0, len(a), b, 0, len(b)):
+        if x < last_x or y < last_y:
+            # Covered by the previous snake
+            continue
+        while x > last_x and y > last_y and a[x - 1] == b[y - 1]:
+            x -= 1
+            y -= 1
+        end_x, end_y = x, y
+        while end_x < len(a) and end_y < len(b) and a[end_x] == b[end_y]:
+            end_x += 1
+            end_y += 1
+        snakes.append((x, y, end_x - x))
+        last_x, last_y = end_x, end_y
+    return snakes
+
+
 DiffChunk = collections.namedtuple('DiffChunk',
                                    'tag, start_a, end_a, start_b, end_b')
 
+TAGS = ('equal', 'replace', 'delete', 'insert', 'conflict')
+TAG_CODES = {tag: code for code, tag in enumerate(TAGS)}
+
+
+class Chunks(collections.abc.Sequence):
+    """List of :class:`DiffChunk` stored in columns.
+
+    Tags are stored as their indices in :data:`TAGS`, and bounds of chunks
+    in arrays of integers. Items are created on access.
+    """
+
+    def __init__(self, chunks=()):
+        self.tags = array.array('b')
+        self.start_a = array.array('i')
+        self.end_a = array.array('i')
+        self.start_b = array.array('i')
+        self.end_b = array.array('i')
+        for chunk in chunks:
+            self.append(*chunk)
+
+    @classmethod
+    def from_blocks(cls, blocks, equal=False):
+        """Build chunks from matching *blocks* like
+        :meth:`difflib.SequenceMatcher.get_opcodes`.
+
+        :param equal: include chunks of matching blocks.
+        """
+        chunks = cls()
+        append = chunks.append
+        i = j = 0
+        for ai, bj, size in blocks:
+            if i < ai and j < bj:
+                append('replace', i, ai, j, bj)
+            elif i < ai:
+                append('delete', i, ai, j, bj)
+            elif j < bj:
+                append('insert', i, ai, j, bj)
+            i, j = ai + size, bj + size
+            if equal and size:
+                append('equal', ai, i, bj, j)
+        return chunks
+
+    def append(self, tag, start_a, end_a, start_b, end_b):
+        self.tags.append(TAG_CODES[tag])
+        self.start_a.append(start_a)
+        self.end_a.append(end_a)
+        self.start_b.append(start_b)
+        self.end_b.append(end_b)
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __iter__(self):
+        return map(DiffChunk._make, zip(map(TAGS.__getitem__, self.tags),
+                                        self.start_a, self.end_a, self.start_b, self.end_b))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            chunks = Chunks()
+            for name in ('tags', 'start_a', 'end_a', 'start_b', 'end_b'):
+                setattr(chunks, name, getattr(self, name)[index])
+            return chunks
+        return DiffChunk(TAGS[self.tags[index]], self.start_a[index], self.end_a[index],
+                         self.start_b[index], self.end_b[index])
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.abc.Sequence):
+            return NotImplemented
+        return len(self) == len(other) and all(x == y for x, y in zip(self, other))
+
+    def __repr__(self):
+        return f'Chunks({list(self)!r})'
+
 
 @attr.s
 class MyersSequenceMatcher(difflib.SequenceMatcher):
+    """Myers diff matcher.
+
+    If *max_cost* is given, the search gives up after exploring that many
+    deletions (value of p in the O(NP) algorithm) and falls back to
+    alignment around unique anchors. In this case :attr:`approximate` is
+    set to True, and the result may not be the shortest diff.
+
+    The value of p reached by the search is stored in :attr:`cost`.
+    """
 
     isjunk = attr.ib(default=None)
     a = attr.ib(default="")
     b = attr.ib(default="")
+    max_cost = attr.ib(default=None)
 
     def __attrs_post_init__(self):
         if self.isjunk is not None:
@@ -76,6 +257,8 @@ class MyersSequenceMatcher(difflib.SequenceMatcher):
         self.bindex = []
         self.common_prefix = self.common_suffix = 0
         self.lines_discarded = False
+        self.approximate = False
+        self.cost = 0
 
     def get_matching_blocks(self):
         if self.matching_blocks is None:
@@ -83,11 +266,10 @@ class MyersSequenceMatcher(difflib.SequenceMatcher):
         return self.matching_blocks
 
     def get_opcodes(self):
-        opcodes = difflib.SequenceMatcher.get_opcodes(self)
-        return [DiffChunk._make(chunk) for chunk in opcodes]
+        return Chunks.from_blocks(self.get_matching_blocks(), equal=True)
 
     def get_difference_opcodes(self):
-        return [chunk for chunk in self.get_opcodes() if chunk.tag != "equal"]
+        return Chunks.from_blocks(self.get_matching_blocks())
 
     def preprocess_remove_prefix_suffix(self, a, b):
         # remove common prefix and common suffix
@@ -169,6 +351,46 @@ class MyersSequenceMatcher(difflib.SequenceMatcher):
         mb.reverse()
         self.matching_blocks = mb
 
+    def match_range(self, a, alo, ahi, b, blo, bhi):
+        """Compare ranges a[alo:ahi] and b[blo:bhi] with the O(NP) algorithm.
+
+        This is used by matchers that split sequences into smaller ranges.
+
+        :returns: list of matching blocks (i, j, n) relative to *a* and *b*.
+        """
+        matcher = MyersSequenceMatcher(None, a[alo:ahi], b[blo:bhi], max_cost=self.max_cost)
+        blocks = [(alo + i, blo + j, n) for i, j, n in matcher.get_matching_blocks()[:-1]]
+        self.approximate = self.approximate or matcher.approximate
+        self.cost = max(self.cost, matcher.cost)
+        return blocks
+
+    def join_blocks(self, blocks):
+        """Build list of matching blocks from unordered *blocks* found in
+        sequences with common prefix and suffix removed.
+
+        Adjacent blocks are joined, and blocks for common prefix and suffix
+        are added.
+        """
+        blocks.sort()
+        common_prefix = self.common_prefix
+        self.matching_blocks = matching_blocks = []
+        if common_prefix:
+            matching_blocks.append((0, 0, common_prefix))
+        for i, j, n in blocks:
+            i += common_prefix
+            j += common_prefix
+            if matching_blocks:
+                pi, pj, pn = matching_blocks[-1]
+                if pi + pn == i and pj + pn == j:
+                    matching_blocks[-1] = (pi, pj, pn + n)
+                    continue
+            matching_blocks.append((i, j, n))
+        if self.common_suffix:
+            matching_blocks.append((len(self.a) - self.common_suffix,
+                                    len(self.b) - self.common_suffix,
+                                    self.common_suffix))
+        matching_blocks.append((len(self.a), len(self.b), 0))
+
     def build_matching_blocks(self, lastsnake):
         """Build list of matching blocks based on snakes
 
@@ -178,45 +400,41 @@ class MyersSequenceMatcher(difflib.SequenceMatcher):
          * shift positions and split blocks based on the list of discarded
            non-matching lines
         """
-        self.matching_blocks = matching_blocks = []
-
-        common_prefix = self.common_prefix
-        common_suffix = self.common_suffix
-        aindex = self.aindex
-        bindex = self.bindex
+        snakes = []
         while lastsnake is not None:
             lastsnake, x, y, snake = lastsnake
-            if self.lines_discarded:
-                # split snakes if needed because of discarded lines
-                x += snake - 1
-                y += snake - 1
-                xprev = aindex[x] + common_prefix
-                yprev = bindex[y] + common_prefix
-                if snake > 1:
-                    newsnake = 1
-                    for i in range(1, snake):
-                        x -= 1
-                        y -= 1
-                        xnext = aindex[x] + common_prefix
-                        ynext = bindex[y] + common_prefix
-                        if (xprev - xnext != 1) or (yprev - ynext != 1):
-                            matching_blocks.insert(0, (xprev, yprev, newsnake))
-                            newsnake = 0
-                        xprev = xnext
-                        yprev = ynext
-                        newsnake += 1
-                    matching_blocks.insert(0, (xprev, yprev, newsnake))
-                else:
-                    matching_blocks.insert(0, (xprev, yprev, snake))
-            else:
-                matching_blocks.insert(0, (x + common_prefix,
-                                           y + common_prefix, snake))
+            snakes.append((x, y, snake))
+        snakes.reverse()
+
+        common_prefix = self.common_prefix
+        self.matching_blocks = matching_blocks = []
         if common_prefix:
-            matching_blocks.insert(0, (0, 0, common_prefix))
-        if common_suffix:
-            matching_blocks.append((len(self.a) - common_suffix,
-                                    len(self.b) - common_suffix,
-                                    common_suffix))
+            matching_blocks.append((0, 0, common_prefix))
+        if self.lines_discarded:
+            # Split snakes where discarded lines were between their lines.
+            # Runs of consecutive lines have equal index[k] - k, which is
+            # nondecreasing, so the end of a run is found by bisection.
+            aindex = self.aindex
+            bindex = self.bindex
+            adiag = [i - k for k, i in enumerate(aindex)]
+            bdiag = [j - k for k, j in enumerate(bindex)]
+            for x, y, snake in snakes:
+                shift = y - x
+                xend = x + snake
+                while x < xend:
+                    y = x + shift
+                    end = min(bisect.bisect_right(adiag, adiag[x], x, xend),
+                              bisect.bisect_right(bdiag, bdiag[y], y, xend + shift) - shift)
+                    matching_blocks.append((aindex[x] + common_prefix,
+                                            bindex[y] + common_prefix, end - x))
+                    x = end
+        else:
+            for x, y, snake in snakes:
+                matching_blocks.append((x + common_prefix, y + common_prefix, snake))
+        if self.common_suffix:
+            matching_blocks.append((len(self.a) - self.common_suffix,
+                                    len(self.b) - self.common_suffix,
+                                    self.common_suffix))
         matching_blocks.append((len(self.a), len(self.b), 0))
         # clean-up to free memory
         self.aindex = self.bindex = None
@@ -237,12 +455,19 @@ class MyersSequenceMatcher(difflib.SequenceMatcher):
         delta = n - m + middle
         dmin = min(middle, delta)
         dmax = max(middle, delta)
+        max_cost = self.max_cost
         if n > 0 and m > 0:
             size = n + m + 2
             fp = [(-1, None)] * size
             p = -1
             while True:
                 p += 1
+                if max_cost is not None and p > max_cost:
+                    lastsnake = None
+                    for snake in anchor_snakes(a, b):
+                        lastsnake = (lastsnake,) + snake
+                    self.approximate = True
+                    break
                 # move along vertical edge
                 yv = -1
                 node = None
@@ -302,5 +527,127 @@ class MyersSequenceMatcher(difflib.SequenceMatcher):
                 if y >= n:
                     lastsnake = node
                     break
+            self.cost = p
         self.build_matching_blocks(lastsnake)
         self.postprocess()
+
+
+def find_middle_snake(a, alo, ahi, b, blo, bhi):
+    """Find the middle snake of a shortest edit script between
+    a[alo:ahi] and b[blo:bhi] in linear space.
+
+    The ranges must not have common prefix or suffix.
+
+    Based on "An O(ND) Difference Algorithm and Its Variations" by Eugene
+    Myers (1986), as implemented in Neil Fraser's diff-match-patch.
+
+    :returns: split point (x, y) relative to (alo, blo), or None if the
+        ranges have nothing in common.
+    """
+    n = ahi - alo
+    m = bhi - blo
+    max_d = (n + m + 1) // 2
+    v_offset = max_d
+    v_length = 2 * max_d + 2
+    v1 = [-1] * v_length
+    v1[v_offset + 1] = 0
+    v2 = v1[:]
+    delta = n - m
+    # If the total number of elements is odd, then the front path will
+    # collide with the reverse path.
+    front = delta % 2 != 0
+    # Offsets for start and end of k loop, prevent mapping of space beyond
+    # the grid.
+    k1start = k1end = k2start = k2end = 0
+    for d in range(max_d):
+        # Walk the front path one step.
+        for k1 in range(-d + k1start, d + 1 - k1end, 2):
+            k1_offset = v_offset + k1
+            if k1 == -d or (k1 != d and v1[k1_offset - 1] < v1[k1_offset + 1]):
+                x1 = v1[k1_offset + 1]
+            else:
+                x1 = v1[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[alo + x1] == b[blo + y1]:
+                x1 += 1
+                y1 += 1
+            v1[k1_offset] = x1
+            if x1 > n:
+                # Ran off the right of the graph.
+                k1end += 2
+            elif y1 > m:
+                # Ran off the bottom of the graph.
+                k1start += 2
+            elif front:
+                k2_offset = v_offset + delta - k1
+                if 0 <= k2_offset < v_length and v2[k2_offset] != -1:
+                    # Mirror x2 onto top-left coordinate system.
+                    x2 = n - v2[k2_offset]
+                    if x1 >= x2:
+                        return x1, y1
+
+        # Walk the reverse path one step.
+        for k2 in range(-d + k2start, d + 1 - k2end, 2):
+            k2_offset = v_offset + k2
+            if k2 == -d or (k2 != d and v2[k2_offset - 1] < v2[k2_offset + 1]):
+                x2 = v2[k2_offset + 1]
+            else:
+                x2 = v2[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and a[ahi - x2 - 1] == b[bhi - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            v2[k2_offset] = x2
+            if x2 > n:
+                # Ran off the left of the graph.
+                k2end += 2
+            elif y2 > m:
+                # Ran off the top of the graph.
+                k2start += 2
+            elif not front:
+                k1_offset = v_offset + delta - k2
+                if 0 <= k1_offset < v_length and v1[k1_offset] != -1:
+                    x1 = v1[k1_offset]
+                    y1 = v_offset + x1 - k1_offset
+                    # Mirror x2 onto top-left coordinate system.
+                    x2 = n - x2
+                    if x1 >= x2:
+                        return x1, y1
+    return None
+
+
+@attr.s
+class LinearMyersSequenceMatcher(MyersSequenceMatcher):
+    """Myers matcher that works in linear space.
+
+    Ranges larger than *memory_limit* elements in total are split in two
+    at the middle snake of their shortest edit script, smaller ranges are
+    compared by the O(NP) algorithm of :class:`MyersSequenceMatcher`.
+    This keeps memory bounded when sequences differ almost completely.
+    """
+
+    memory_limit = attr.ib(default=10000)
+
+    def initialise(self):
+        a, b = self.preprocess_remove_prefix_suffix(self.a, self.b)
+        blocks = []
+        ranges = [(0, len(a), 0, len(b))]
+        while ranges:
+            alo, ahi, blo, bhi = ranges.pop()
+            alo, ahi, blo, bhi = trim_range(a, alo, ahi, b, blo, bhi, blocks)
+            if alo == ahi or blo == bhi:
+                continue
+
+            split = None
+            if (ahi - alo) + (bhi - blo) > self.memory_limit:
+                split = find_middle_snake(a, alo, ahi, b, blo, bhi)
+                if split is None:
+                    continue
+            if split is None or split in ((0, 0), (ahi - alo, bhi - blo)):
+                blocks.extend(self.match_range(a, alo, ahi, b, blo, bhi))
+                continue
+            x, y = split
+            ranges.append((alo + x, ahi, blo + y, bhi))
+            ranges.append((alo, alo + x, blo, blo + y))
+        self.join_blocks(blocks)
+        self.postprocess()
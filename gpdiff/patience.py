@@ -0,0 +1,83 @@
+import collections
+
+import attr
+
+from .myers import MyersSequenceMatcher, longest_increasing, trim_range, unique_anchors
+
+
+def low_occurrence_anchors(a, alo, ahi, b, blo, bhi, max_occurrences):
+    """Find anchors to split ranges a[alo:ahi] and b[blo:bhi] at.
+
+    Elements that occur exactly once in both ranges are preferred, as in
+    patience diff. Otherwise, as in histogram diff, the elements that occur
+    the same, lowest number of times in both ranges (but no more than
+    *max_occurrences* times) are used, and their occurrences are paired in
+    order.
+
+    :returns: list of pairs (i, j) such that a[i] == b[j], increasing in
+        both *i* and *j*.
+    """
+    anchors = unique_anchors(a, alo, ahi, b, blo, bhi)
+    if anchors:
+        return anchors
+
+    positions_a = collections.defaultdict(list)
+    for i in range(alo, ahi):
+        positions_a[a[i]].append(i)
+    positions_b = collections.defaultdict(list)
+    for j in range(blo, bhi):
+        a_positions = positions_a.get(b[j])
+        if a_positions and len(a_positions) <= max_occurrences:
+            positions_b[b[j]].append(j)
+
+    lowest = None
+    for e, js in positions_b.items():
+        count = len(js)
+        if count == len(positions_a[e]) and (lowest is None or count < lowest):
+            lowest = count
+    if lowest is None:
+        return []
+    candidates = []
+    for e, js in positions_b.items():
+        if len(js) == lowest == len(positions_a[e]):
+            candidates.extend(zip(positions_a[e], js))
+    candidates.sort()
+    return longest_increasing(candidates)
+
+
+@attr.s
+class PatienceSequenceMatcher(MyersSequenceMatcher):
+    """Patience/histogram diff matcher.
+
+    Sequences are split recursively at elements that occur rarely in both
+    of them, see :func:`low_occurrence_anchors`. Ranges without such
+    elements are compared by the O(NP) algorithm of
+    :class:`gpdiff.myers.MyersSequenceMatcher`.
+
+    Unlike greedy Myers diff, this aligns repeated measures, such as rests
+    and loops, around the distinctive measures between them.
+    """
+
+    max_occurrences = attr.ib(default=64)
+
+    def initialise(self):
+        a, b = self.preprocess_remove_prefix_suffix(self.a, self.b)
+        blocks = []
+        ranges = [(0, len(a), 0, len(b))]
+        while ranges:
+            alo, ahi, blo, bhi = ranges.pop()
+            alo, ahi, blo, bhi = trim_range(a, alo, ahi, b, blo, bhi, blocks)
+            if alo == ahi or blo == bhi:
+                continue
+
+            anchors = low_occurrence_anchors(a, alo, ahi, b, blo, bhi, self.max_occurrences)
+            if not anchors:
+                blocks.extend(self.match_range(a, alo, ahi, b, blo, bhi))
+                continue
+            for i, j in anchors:
+                ranges.append((alo, i, blo, j))
+                blocks.append((i, j, 1))
+                alo, blo = i + 1, j + 1
+            ranges.append((alo, ahi, blo, bhi))
+        self.join_blocks(blocks)
+        self.postprocess()
@@ -0,0 +1,210 @@
+"""Diff server that keeps parsed songs in memory between requests.
+
+The server listens on a Unix socket and speaks JSON lines: every request
+is a JSON object on a line, answered with a JSON object on a line. A
+connection may send any number of requests.
+
+Diff request holds arguments of :func:`gpdiff.differ.execute`::
+
+    {"files": ["/abs/mine.gp5", "/abs/old.gp5", "/abs/yours.gp5"],
+     "format": "text", "output": "/abs/merged.gp5", "batch": false,
+     "algorithm": "myers", "max_cost": null}
+
+and is answered with the exit status and lines of the report, or with an
+error message::
+
+    {"status": 1, "output": ["..."]}
+    {"status": 2, "error": "..."}
+
+Request ``{"command": "stats"}`` returns statistics of the song cache.
+"""
+
+import argparse
+import collections
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+from concurrent import futures
+
+from . import cache
+from . import flatten
+from .differ import execute
+
+
+class Entry:
+    """Parsed and flattened song in :class:`SongCache`.
+
+    :attr:`tokens` is a tuple (interner, keys) of the interned song, or
+    None if the song isn't interned yet.
+    """
+
+    __slots__ = ('song', 'sequence', 'tokens')
+
+    def __init__(self, song, sequence):
+        self.song = song
+        self.sequence = sequence
+        self.tokens = None
+
+
+class SongCache:
+    """LRU cache of parsed and flattened songs keyed by digest of file
+    contents.
+
+    Songs are interned by one interner shared by all requests, so that
+    cached songs aren't hashed again. Songs are interned outside of the
+    lock, so cold requests don't wait for each other. The interner keeps
+    elements of songs that left the cache, so it's replaced with a new one
+    after it has interned twice as many songs as the cache holds, and
+    songs interned by the old one are interned again on their next use.
+
+    :param maxsize: number of songs to keep.
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._interner = flatten.Interner()
+        self._interned = 0
+
+    def load(self, path):
+        """Parse and flatten file at *path*, or take it from the cache.
+
+        :returns: :class:`Entry` of the song.
+        """
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        key = cache.digest(data)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        # Parse outside of the lock so that other requests can go on
+        entry = Entry(*cache.parse(data))
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def load_all(self, paths):
+        """Load files at *paths* and intern them with one interner.
+
+        :returns: tuple (songs, sequences, keys, interner).
+        """
+        entries = [self.load(path) for path in paths]
+        with self._lock:
+            stale = any(entry.tokens is None or entry.tokens[0] is not self._interner for entry in entries)
+            if stale and self._interned >= 2 * self.maxsize:
+                self._interner = flatten.Interner()
+                self._interned = 0
+            interner = self._interner
+        keys = []
+        for entry in entries:
+            tokens = entry.tokens
+            if tokens is None or tokens[0] is not interner:
+                # Intern outside of the lock so that other requests can go on
+                tokens = entry.tokens = (interner, interner.intern(entry.sequence))
+                with self._lock:
+                    self._interned += 1
+            keys.append(tokens[1])
+        return [entry.song for entry in entries], [entry.sequence for entry in entries], keys, interner
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'maxsize': self.maxsize,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+def process(songs, request):
+    """Process *request* using *songs* cache and return the response."""
+    command = request.get('command', 'diff')
+    if command == 'stats':
+        return {'status': 0, 'cache': songs.stats()}
+    elif command != 'diff':
+        return {'status': 2, 'error': f'unknown command {command!r}'}
+
+    files = request['files']
+    loaded_songs, sequences, keys, interner = songs.load_all(files)
+    status, lines = execute(
+        files, loaded_songs, sequences, keys=keys, interner=interner,
+        fmt=request.get('format', 'text'), output=request.get('output'), batch=request.get('batch', False),
+        algorithm=request.get('algorithm', 'myers'), max_cost=request.get('max_cost'))
+    return {'status': status, 'output': list(lines)}
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError as exc:
+                response = {'status': 2, 'error': f'invalid request: {exc}'}
+            else:
+                response = self.server.submit(request).result()
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Server that processes requests on a pool of *jobs* worker threads.
+
+    Workers are threads rather than processes, so that they share the
+    song cache.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, jobs=None, cache_size=64):
+        super().__init__(path, Handler)
+        self.songs = SongCache(cache_size)
+        self.executor = futures.ThreadPoolExecutor(jobs)
+
+    def submit(self, request):
+        return self.executor.submit(self._process, request)
+
+    def _process(self, request):
+        try:
+            return process(self.songs, request)
+        except Exception as exc:
+            return {'status': 2, 'error': f'{type(exc).__name__}: {exc}'}
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
+        os.unlink(self.server_address)
+
+
+parser = argparse.ArgumentParser(prog='gpdiff-server', description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('SOCKET', help='path of Unix socket to listen on')
+parser.add_argument('-j', '--jobs', type=int,
+                    help='number of worker threads (default: depends on number of CPUs)')
+parser.add_argument('--cache-size', type=int, default=64,
+                    help='number of parsed songs to keep in memory (default: %(default)s)')
+
+
+def main():
+    args = parser.parse_args()
+    if os.path.exists(args.SOCKET):
+        parser.error(f'{args.SOCKET} already exists')
+    # Shut down cleanly and remove the socket on SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with Server(args.SOCKET, args.jobs, args.cache_size) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
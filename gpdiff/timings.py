@@ -0,0 +1,64 @@
+import contextlib
+import time
+import tracemalloc
+
+_hooks = []
+
+
+def add_hook(hook):
+    """Call *hook* after every instrumented stage of diff and merge.
+
+    The hook is called with the name of the stage, its wall time in
+    seconds, and a dict of metrics, e.g. numbers of tokens or chunks.
+    Stages that run in worker processes are not reported.
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """Stop calling *hook* added with :func:`add_hook`."""
+    _hooks.remove(hook)
+
+
+@contextlib.contextmanager
+def stage(name, **metrics):
+    """Measure the stage *name* of the code in the ``with`` block.
+
+    The block may add metrics to the yielded dict. If tracemalloc is
+    tracing, peak memory of the stage is added as ``peak_memory``.
+    Nothing is measured while no hooks are added.
+    """
+    if not _hooks:
+        yield metrics
+        return
+    tracing = tracemalloc.is_tracing()
+    if tracing and hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    yield metrics
+    elapsed = time.perf_counter() - start
+    if tracing:
+        metrics['peak_memory'] = tracemalloc.get_traced_memory()[1]
+    for hook in list(_hooks):
+        hook(name, elapsed, metrics)
+
+
+class Recorder:
+    """Hook that keeps records of stages, see :func:`add_hook`."""
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, name, elapsed, metrics):
+        self.records.append((name, elapsed, dict(metrics)))
+
+    def report(self):
+        """Return lines of report of recorded stages."""
+        for name, elapsed, metrics in self.records:
+            details = []
+            for key, value in metrics.items():
+                if key == 'peak_memory':
+                    details.append(f'peak={value / 2 ** 20:.1f}MiB')
+                elif value is not None:
+                    details.append(f'{key}={value}')
+            yield ' '.join([f'{name:<12} {elapsed:9.4f}s'] + details)
@@ -0,0 +1,68 @@
+import os
+
+from . import cache
+
+EXTENSIONS = ('.gp3', '.gp4', '.gp5')
+
+
+def find_files(root):
+    """Return sorted list of paths of Guitar Pro files under directory
+    *root*, relative to it."""
+    result = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in filenames:
+            if filename.lower().endswith(EXTENSIONS):
+                path = os.path.join(dirpath, filename)
+                result.append(os.path.relpath(path, root))
+    result.sort()
+    return result
+
+
+def diff_trees(old_dir, new_dir, diff, executor=None):
+    """Compare Guitar Pro files in two directories.
+
+    Files are paired by their paths relative to *old_dir* and *new_dir*.
+    Files with the same contents are skipped without parsing, the other
+    pairs are passed to *diff*, on *executor* if it's given.
+
+    :param diff: function that takes paths to old and new files and
+        returns a list of report lines. It must be picklable to run in a
+        process pool.
+    :returns: iterator of tuples (path, status, lines), where status is
+        one of 'added', 'removed', 'unchanged', 'changed'.
+    """
+    old_files = set(find_files(old_dir))
+    new_files = set(find_files(new_dir))
+    statuses = {}
+    for path in old_files | new_files:
+        if path not in new_files:
+            statuses[path] = 'removed'
+        elif path not in old_files:
+            statuses[path] = 'added'
+        elif (cache.file_digest(os.path.join(old_dir, path)) ==
+              cache.file_digest(os.path.join(new_dir, path))):
+            statuses[path] = 'unchanged'
+        else:
+            statuses[path] = 'changed'
+
+    changed = sorted(path for path, status in statuses.items() if status == 'changed')
+    old_paths = [os.path.join(old_dir, path) for path in changed]
+    new_paths = [os.path.join(new_dir, path) for path in changed]
+    if executor is not None:
+        reports = executor.map(diff, old_paths, new_paths)
+    else:
+        reports = map(diff, old_paths, new_paths)
+
+    for path in sorted(statuses):
+        status = statuses[path]
+        lines = next(reports) if status == 'changed' else []
+        yield path, status, lines
+
+
+def summarize(statuses):
+    """Return summary line for given list of file *statuses*."""
+    counts = {status: statuses.count(status)
+              for status in ('changed', 'added', 'removed', 'unchanged')}
+    details = ', '.join(f'{count} {status}' for status, count in counts.items())
+    return f'{len(statuses)} files: {details}'
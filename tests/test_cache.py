@@ -0,0 +1,26 @@
+import guitarpro
+
+from gpdiff import cache
+from gpdiff.differ import load
+from gpdiff.flatten import flatten
+
+from test_gpdiff import make_song, write_songs
+
+
+def test_load(tmp_path):
+    path, = write_songs(tmp_path, make_song(2, 8))
+    song = guitarpro.parse(path)
+
+    parsed, sequence = cache.load(path)
+    assert parsed == song
+    assert tuple(sequence) == flatten(song)
+    assert sequence[-1].track is parsed.tracks[-1]
+    with open(path, 'rb') as fp:
+        assert cache.file_digest(path) == cache.digest(fp.read())
+
+
+def test_load_files(tmp_path):
+    files = write_songs(tmp_path, make_song(), make_song(2))
+    songs, sequences = load(files)
+    assert [len(song.tracks) for song in songs] == [1, 2]
+    assert [tuple(sequence) for sequence in sequences] == [flatten(song) for song in songs]
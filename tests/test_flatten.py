@@ -1,7 +1,7 @@
 import attr
 import guitarpro
 
-from gpdiff.flatten import flat_obj, flatten, restore
+from gpdiff.flatten import Interner, flat_obj, flatten, restore
 
 
 @attr.s
@@ -33,3 +33,46 @@ def test_restore():
     flat_song = flatten(song)
     restored_song = restore(flat_song)
     assert song == restored_song
+
+
+def test_interner():
+    song = guitarpro.Song()
+    other = guitarpro.Song(tempo=100)
+    interner = Interner()
+    tokens = interner.intern(flatten(song))
+    other_tokens = interner.intern(flatten(other))
+    assert len(tokens) == len(other_tokens) == len(flatten(song))
+    assert all(isinstance(t, int) for t in tokens)
+    changed = [i for i, (x, y) in enumerate(zip(tokens, other_tokens)) if x != y]
+    assert [flatten(other)[i] for i in changed] == [('tempo', 100)]
+
+
+def test_flat_song():
+    song = guitarpro.Song()
+    song.tracks.append(guitarpro.Track(song, number=2))
+    flat = flatten(song)
+    view = flatten(song, view=True)
+    assert len(view) == len(flat)
+    assert tuple(view) == flat
+    assert [view[i] for i in range(-len(flat), len(flat))] == list(flat + flat)
+    for start in range(len(flat) + 1):
+        for stop in range(start, len(flat) + 2):
+            assert view[start:stop] == flat[start:stop]
+    assert view[::3] == flat[::3]
+    assert view[-1] is song.tracks[-1].measures[-1]
+
+
+def test_restore_copies_measures():
+    song = guitarpro.Song()
+    song.newMeasure()
+    song.measureHeaders[1].number = 2
+    song.tracks.append(guitarpro.Track(song, number=2))
+    flat = flatten(song, view=True)
+    # Drop the first measure of the second track
+    restored = restore(flat[:-2] + flat[-1:])
+    measure = song.tracks[1].measures[1]
+    assert measure.track is song.tracks[1]
+    assert measure.number == 2
+    assert restored.tracks[1].measures[0].number == 1
+    assert restored.tracks[1].measures[0].track is restored.tracks[1]
+    assert restored.tracks[1].measures[0] == measure
@@ -0,0 +1,391 @@
+import copy
+import json
+import os
+import subprocess
+import sys
+from concurrent import futures
+
+import guitarpro
+import pytest
+
+import gpdiff
+from gpdiff import cache, diffutil, timings
+from gpdiff.diffutil import Differ
+from gpdiff.flatten import Interner, flatten, track_spans
+from gpdiff.hierarchy import HierarchicalMatcher
+from gpdiff.differ import GPDiffer, MergeError, matchers
+from gpdiff.gpdiff import algorithms, cli
+
+
+def make_song(tracks=1, measures=4):
+    """Build a song where every measure holds a distinct note."""
+    song = guitarpro.Song()
+    for _ in range(measures - 1):
+        song.newMeasure()
+    for number, header in enumerate(song.measureHeaders, start=1):
+        header.number = number
+    for number in range(2, tracks + 1):
+        song.tracks.append(guitarpro.Track(song, number=number, name=f'Track {number}'))
+    for track in song.tracks:
+        for measure in track.measures:
+            set_note(measure, track.number * 100 + measure.number)
+    return song
+
+
+def set_note(measure, value):
+    voice = measure.voices[0]
+    beat = guitarpro.Beat(voice, status=guitarpro.BeatStatus.normal)
+    beat.notes.append(guitarpro.Note(beat, value=value % 25, string=value % 6 + 1,
+                                     velocity=value, type=guitarpro.NoteType.normal))
+    voice.beats[:] = [beat]
+
+
+def write_songs(tmp_path, *songs):
+    files = []
+    for i, song in enumerate(songs):
+        path = str(tmp_path / f'{i}.gp5')
+        guitarpro.write(song, path)
+        files.append(path)
+    return files
+
+
+def test_diff_2way(tmp_path):
+    old, new = make_song(), make_song()
+    new.tempo = 90
+    set_note(new.tracks[0].measures[2], 1)
+    differ = GPDiffer(write_songs(tmp_path, new, old), [new, old])
+    lines = list(differ.show())
+    assert '- Song: tempo = 120' in lines
+    assert '+ Song: tempo = 90' in lines
+    assert '[!] 3' in lines
+
+
+def test_merge_3way(tmp_path, capsys):
+    old, mine, yours = make_song(2), make_song(2), make_song(2)
+    set_note(mine.tracks[0].measures[0], 1)
+    set_note(yours.tracks[1].measures[3], 2)
+    files = write_songs(tmp_path, mine, old, yours)
+    differ = GPDiffer(files, [mine, old, yours])
+    assert not differ.conflicts
+    merged = differ.merge()
+    assert merged.tracks[0].measures[0] == mine.tracks[0].measures[0]
+    assert merged.tracks[1].measures[3] == yours.tracks[1].measures[3]
+    assert merged.tracks[0].measures[1] == old.tracks[0].measures[1]
+
+    output = str(tmp_path / 'merged.gp5')
+    assert cli([files[1], files[0], files[2], '-o', output, '-f', 'json']) == 0
+    assert json.loads(capsys.readouterr().out) == []
+    assert guitarpro.parse(output).tracks[1].measures[3] == guitarpro.parse(files[2]).tracks[1].measures[3]
+
+
+def test_merge_removed_tracks(tmp_path, capsys):
+    old, mine, yours = make_song(2), make_song(2), make_song(2)
+    del mine.tracks[0]
+    mine.tracks[0].number = 1
+    del yours.tracks[1]
+    files = write_songs(tmp_path, mine, old, yours)
+    with pytest.raises(MergeError):
+        GPDiffer(files, [mine, old, yours]).merge()
+    output = str(tmp_path / 'merged.gp5')
+    with pytest.raises(SystemExit) as excinfo:
+        cli([files[1], files[0], files[2], '-o', output])
+    assert excinfo.value.code == 2
+    assert 'removed all tracks' in capsys.readouterr().err
+    assert not os.path.exists(output)
+
+
+def test_identical(tmp_path, capsys, monkeypatch):
+    old, mine, yours = make_song(2), make_song(2), make_song(2)
+    set_note(yours.tracks[1].measures[3], 2)
+    files = write_songs(tmp_path, mine, old, yours)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('files should not be parsed')
+
+    monkeypatch.setattr(cache, 'load', fail)
+    assert cli(files[:2]) == 0
+    assert capsys.readouterr().out == ''
+    assert cli(['-f', 'json'] + files[:2]) == 0
+    assert json.loads(capsys.readouterr().out) == []
+    output = str(tmp_path / 'merged.gp5')
+    assert cli([files[1], files[0], files[2], '-o', output, '-f', 'json']) == 0
+    assert json.loads(capsys.readouterr().out) == []
+    with open(output, 'rb') as merged, open(files[2], 'rb') as fp:
+        assert merged.read() == fp.read()
+
+
+def test_equal_sequences(tmp_path):
+    def fail(*args):
+        raise AssertionError('equal sequences should not be matched')
+
+    assert diffutil.match(fail, (1, 2, 3), (1, 2, 3)) == ([], False)
+    old, mine, yours = make_song(2), make_song(2), make_song(2)
+    set_note(yours.tracks[1].measures[3], 2)
+    differ = GPDiffer(write_songs(tmp_path, mine, old, yours), [mine, old, yours])
+    assert not differ.conflicts
+    assert differ.merge() == yours
+
+
+def test_merge_empty_range():
+    # MYFILE removed what YOURFILE changed, the change is taken
+    differ = Differ()
+    differ.set_sequences_iter([[1, 3], [1, 2, 3], [1, 4, 3]])
+    (c0, c1), = differ.all_changes()
+    assert c0 is None
+    assert (c1.tag, c1.start_a, c1.end_a, c1.start_b, c1.end_b) == ('replace', 1, 2, 1, 2)
+    assert not differ.conflicts
+    assert differ.locate(2, 1) == (0, None, None)
+
+
+@pytest.mark.parametrize('executor_class', [futures.ThreadPoolExecutor, futures.ProcessPoolExecutor])
+def test_parallel_3way(tmp_path, monkeypatch, executor_class):
+    old, mine, yours = make_song(2), make_song(2), make_song(2)
+    set_note(mine.tracks[0].measures[0], 1)
+    set_note(yours.tracks[1].measures[3], 2)
+    files = write_songs(tmp_path, mine, old, yours)
+    serial = GPDiffer(files, [mine, old, yours])
+
+    class Executor(executor_class):
+        def submit(self, *args, **kwargs):
+            raise AssertionError('cheap diffs should not be sent to workers')
+
+    with Executor(2) as executor:
+        assert GPDiffer(files, [mine, old, yours], executor=executor).diffs == serial.diffs
+
+    monkeypatch.setattr(Differ, 'parallel_cost', 0)
+    with executor_class(2) as executor:
+        parallel = GPDiffer(files, [mine, old, yours], executor=executor)
+    assert parallel.diffs == serial.diffs
+    assert list(parallel.all_changes()) == list(serial.all_changes())
+
+
+@pytest.mark.parametrize('executor_class', [futures.ThreadPoolExecutor, futures.ProcessPoolExecutor])
+def test_parallel_tracks(tmp_path, monkeypatch, executor_class):
+    old, new = make_song(3), make_song(3)
+    set_note(new.tracks[0].measures[0], 1)
+    set_note(new.tracks[2].measures[3], 2)
+    files = write_songs(tmp_path, new, old)
+    serial = GPDiffer(files, [new, old])
+
+    class Executor(executor_class):
+        def submit(self, *args, **kwargs):
+            raise AssertionError('cheap pairs of tracks should not be sent to workers')
+
+    with Executor(2) as executor:
+        assert GPDiffer(files, [new, old], executor=executor).diffs == serial.diffs
+
+    monkeypatch.setattr(HierarchicalMatcher, 'parallel_cost', 0)
+    with executor_class(2) as executor:
+        assert GPDiffer(files, [new, old], executor=executor).diffs == serial.diffs
+
+
+def test_tracknumber(tmp_path):
+    old, new = make_song(3), make_song(3)
+    new.tracks[1].name = 'Bass'
+    new.tracks[2].measures.pop()
+    differ = GPDiffer(write_songs(tmp_path, new, old), [new, old])
+    lines = list(differ.show())
+    assert "- Track 2: name = 'Track 2'" in lines
+    assert "+ Track 2: name = 'Bass'" in lines
+    assert '[ | |-] 4' in lines
+    assert differ.get_tracknumber(1, 0) == 0
+    for number, (start, _, end) in enumerate(differ._keys[1].tracks, start=1):
+        assert differ.get_tracknumber(1, start + 1) == differ.get_tracknumber(1, end - 1) == number
+
+
+def test_locate(tmp_path):
+    old, mine, yours = make_song(1, 6), make_song(1, 6), make_song(1, 6)
+    set_note(mine.tracks[0].measures[1], 1)
+    set_note(yours.tracks[0].measures[4], 2)
+    differ = GPDiffer(write_songs(tmp_path, mine, old, yours), [mine, old, yours])
+    assert all(cache is None for cache in differ._line_cache)
+    (c0, _), (_, c1) = differ.all_changes()
+    assert differ.locate(0, c0.start_b) == (0, None, None)
+    assert differ.locate(1, c0.start_a) == (0, None, 1)
+    assert differ.locate(1, c1.start_a) == (1, 0, None)
+    assert differ.locate(1, c0.end_a) == (None, 0, 1)
+    assert differ.locate(2, 0) == (None, None, 1)
+    assert differ.locate(2, differ.seqlength[2]) == (None, 1, None)
+    with pytest.raises(IndexError):
+        differ.locate(2, differ.seqlength[2] + 1)
+
+
+def test_show_json(tmp_path):
+    old, new = make_song(2), make_song(2)
+    new.tempo = 90
+    set_note(new.tracks[1].measures[2], 1)
+    differ = GPDiffer(write_songs(tmp_path, new, old), [new, old])
+    records = [json.loads(line) for line in differ.show_json(ndjson=True)]
+    assert json.loads('\n'.join(differ.show_json())) == records
+    tempo, measure = records
+    assert tempo['tag'] == 'replace'
+    assert tempo['old']['elements'] == [{'index': tempo['old']['start'], 'track': None,
+                                         'attribute': 'tempo', 'value': '120'}]
+    assert tempo['new']['elements'][0]['value'] == '90'
+    assert measure['pane'] == 0
+    assert measure['new']['elements'][0]['track'] == 2
+    assert measure['new']['elements'][0]['measure'] == 3
+    assert not any(record['approximate'] for record in records)
+
+    differ = GPDiffer(differ.files, [new, old], max_cost=0)
+    assert differ.approximate
+    assert all(json.loads(line)['approximate'] for line in differ.show_json(ndjson=True))
+
+
+def test_batch(tmp_path, capsys):
+    old = make_song(2)
+    descendants = [make_song(2) for _ in range(3)]
+    for i, song in enumerate(descendants):
+        set_note(song.tracks[i % 2].measures[i], i)
+    files = write_songs(tmp_path, old, *descendants)
+    songs = [old] + descendants
+    with futures.ProcessPoolExecutor(2) as executor:
+        differs = list(GPDiffer.batch(files, songs, executor=executor))
+    assert len(differs) == 3
+    for i, differ in enumerate(differs, start=1):
+        expected = GPDiffer([files[i], files[0]], [songs[i], old])
+        assert differ.diffs == expected.diffs
+        assert list(differ.show()) == list(expected.show())
+
+    assert cli(['--batch', '-f', 'ndjson'] + files) == 0
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [record['file'] for record in records] == files[1:]
+    assert cli(['--batch', '-f', 'json'] + files) == 0
+    assert json.loads(capsys.readouterr().out) == records
+
+
+@pytest.mark.parametrize('pane', [0, 1, 2])
+def test_change_sequence(tmp_path, pane):
+    old, mine, yours = make_song(2, 6), make_song(2, 6), make_song(2, 6)
+    set_note(mine.tracks[0].measures[0], 1)
+    set_note(yours.tracks[1].measures[3], 2)
+    songs = [mine, old, yours]
+    files = write_songs(tmp_path, *songs)
+    differ = GPDiffer(files, songs)
+
+    sequence = list(differ._sequences[pane])
+    index = next(i for i, e in enumerate(sequence)
+                 if isinstance(e, guitarpro.Measure) and e.track.number == 2 and e.number == 2)
+    inserted = []
+    for value in (3, 4):
+        measure = copy.copy(sequence[index])
+        measure.voices = [guitarpro.Voice(measure) for _ in measure.voices]
+        set_note(measure, value)
+        inserted.append(measure)
+    sequence[index:index + 1] = inserted
+    differ.change_sequence(pane, index, 1, inserted)
+
+    sequences = list(differ._sequences)
+    sequences[pane] = sequence
+    expected = GPDiffer(files, songs, sequences=sequences)
+    assert differ.diffs == expected.diffs
+    assert list(differ.all_changes()) == list(expected.all_changes())
+    assert differ.conflicts == expected.conflicts
+    for seq, length in enumerate(expected.seqlength):
+        assert [differ.locate(seq, i) for i in range(length + 1)] == \
+            [expected.locate(seq, i) for i in range(length + 1)]
+    assert list(differ.show()) == list(expected.show())
+    lo, hi = (1, 2) if pane == 1 else (3, 4)
+    assert any(chunk[lo] <= index < chunk[hi] for chunk in differ.diffs[pane // 2])
+
+
+def test_change_sequence_tracks(tmp_path):
+    old, mine = make_song(3, 6), make_song(3, 6)
+    set_note(mine.tracks[2].measures[1], 1)
+    extra = make_song(1, 6)
+    extra.tracks[0].name = 'Extra'
+    for measure in extra.tracks[0].measures:
+        set_note(measure, 7)
+    files = write_songs(tmp_path, mine, old)
+    differ = GPDiffer(files, [mine, old])
+
+    sequence = list(differ._sequences[0])
+    index = differ._keys[0].tracks[1][0]
+    inserted = list(flatten(extra, view=True))[differ._keys[0].tracks[0][0]:]
+    sequence[index:index] = inserted
+    differ.change_sequence(0, index, 0, inserted)
+    assert differ._keys[0].tracks == track_spans(sequence)
+    expected = GPDiffer(files, [mine, old], sequences=[sequence, differ._sequences[1]])
+    assert differ.diffs == expected.diffs
+
+
+def test_change_sequence_batch(tmp_path):
+    old, mine, other = make_song(2, 6), make_song(2, 6), make_song(2, 6)
+    set_note(mine.tracks[1].measures[2], 1)
+    other.tempo = 80
+    for measure in other.tracks[0].measures:
+        set_note(measure, 3)
+    files = write_songs(tmp_path, old, other, mine)
+    _, differ = GPDiffer.batch(files, [old, other, mine])
+    interner = Interner()
+    keys = [interner.intern(flatten(song)) for song in (other, mine, old)]
+    recovered = GPDiffer(files[2::-2], [mine, old], keys=keys[1:])
+
+    for differ in (differ, recovered):
+        sequence = list(differ._sequences[0])
+        index = sequence.index(('tempo', 120))
+        inserted = [('tempo', 90)]
+        sequence[index:index + 1] = inserted
+        differ.change_sequence(0, index, 1, inserted)
+        assert differ._keys[0][index] not in differ._keys[1]
+        expected = GPDiffer(files[2::-2], [mine, old], sequences=[sequence, differ._sequences[1]])
+        assert differ.diffs == expected.diffs
+        assert (index, index + 1) in [(chunk[1], chunk[2]) for chunk in differ.diffs[0]]
+
+
+def test_change_sequence_approximate(tmp_path):
+    old, new = make_song(1, 12), make_song(1, 12)
+    for number in (1, 4, 7, 10):
+        set_note(new.tracks[0].measures[number], 9)
+    differ = GPDiffer(write_songs(tmp_path, new, old), [new, old], max_cost=1)
+    assert differ.approximate
+    start = differ._keys[0].tracks[0][1]
+    measures = list(differ._sequences[1][start:])
+    differ.change_sequence(0, start, len(measures), measures)
+    assert not differ.approximate
+    assert list(differ.diffs[0]) == []
+
+
+def test_timings(tmp_path, capsys):
+    old, mine, yours = make_song(2), make_song(2), make_song(2)
+    set_note(mine.tracks[0].measures[0], 1)
+    set_note(yours.tracks[1].measures[3], 2)
+    files = write_songs(tmp_path, mine, old, yours)
+    recorder = timings.Recorder()
+    timings.add_hook(recorder)
+    try:
+        differ = GPDiffer(files, [mine, old, yours])
+        differ.merge()
+        differ.locate(1, 0)
+    finally:
+        timings.remove_hook(recorder)
+    names = [name for name, _, _ in recorder.records]
+    assert names == ['intern', 'match', 'match', 'merge_cache', 'merge', 'line_cache']
+    _, _, metrics = recorder.records[1]
+    assert metrics['chunks'] == 1
+    assert metrics['p'] == 1
+
+    profile = str(tmp_path / 'profile')
+    assert cli([files[1], files[0], '--timings', '--profile', profile]) == 0
+    err = capsys.readouterr().err.splitlines()
+    stages = ['parse', 'flatten', 'parse', 'flatten', 'intern', 'match', 'merge_cache', 'report']
+    assert [line.split()[0] for line in err] == stages
+    assert 'peak=' in err[0]
+    assert os.path.getsize(profile) > 0
+
+
+def test_startup_imports():
+    assert sorted(matchers) == list(algorithms)
+    # Heavy dependencies are imported only when files are compared
+    code = ('import sys\n'
+            'from gpdiff.gpdiff import cli\n'
+            'for argv in [[], ["--help"], ["--version"]]:\n'
+            '    try:\n'
+            '        cli(argv)\n'
+            '    except SystemExit:\n'
+            '        pass\n'
+            'print(sorted({"attr", "guitarpro", "gpdiff.differ"} & set(sys.modules)))\n')
+    root = os.path.dirname(os.path.dirname(gpdiff.__file__))
+    result = subprocess.run([sys.executable, '-c', code], cwd=root, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, universal_newlines=True, check=True)
+    assert result.stdout.splitlines()[-1] == '[]'
@@ -0,0 +1,58 @@
+import guitarpro
+
+from gpdiff.flatten import Interner, flatten, track_spans
+from gpdiff.hierarchy import HierarchicalMatcher
+from gpdiff.myers import MyersSequenceMatcher
+
+from test_gpdiff import make_song, set_note
+
+
+def opcodes(matcher, old, new):
+    interner = Interner()
+    a, b = interner.intern(flatten(old)), interner.intern(flatten(new))
+    return matcher(None, a, b).get_difference_opcodes()
+
+
+def test_track_spans():
+    song = make_song(3, 4)
+    sequence = flatten(song)
+    spans = track_spans(sequence)
+    assert len(spans) == 3
+    for (start, measures_start, end), track in zip(spans, song.tracks):
+        assert sequence[start] is guitarpro.Track
+        assert sequence[measures_start:end] == tuple(track.measures)
+    assert spans[-1][2] == len(sequence)
+
+
+def test_same_as_flat():
+    old, new = make_song(3, 6), make_song(3, 6)
+    new.tempo = 90
+    set_note(new.tracks[0].measures[1], 1)
+    set_note(new.tracks[2].measures[5], 2)
+    new.tracks[1].measures.pop(3)
+    new.tracks[1].name = 'Bass'
+    assert opcodes(HierarchicalMatcher, old, new) == opcodes(MyersSequenceMatcher, old, new)
+
+
+def test_inserted_track():
+    old, new = make_song(2, 4), make_song(3, 4)
+    new.tracks[1:] = reversed(new.tracks[1:])
+    sequence = flatten(new)
+    start, _, end = track_spans(sequence)[1]
+    assert opcodes(HierarchicalMatcher, old, new) == [('insert', start, start, start, end)]
+
+
+def test_rematch():
+    old, new = make_song(3, 6), make_song(3, 6)
+    set_note(new.tracks[0].measures[1], 1)
+    interner = Interner()
+    a, b = interner.intern(flatten(old)), interner.intern(flatten(new))
+    known = HierarchicalMatcher(None, a, b).get_matching_blocks()[:-1]
+
+    set_note(new.tracks[2].measures[4], 2)
+    b = interner.intern(flatten(new))
+    index = b.tracks[2][1] + 4
+    m = HierarchicalMatcher(None, a, b)
+    assert m.rematch(known, (1, index, index + 1)) == (opcodes(HierarchicalMatcher, old, new), False)
+    # Song attributes and the first two tracks keep their known blocks
+    assert m.reused == 3
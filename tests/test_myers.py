@@ -0,0 +1,92 @@
+import difflib
+import pickle
+import random
+
+import pytest
+
+from gpdiff.myers import Chunks, LinearMyersSequenceMatcher, MyersSequenceMatcher
+from gpdiff.patience import PatienceSequenceMatcher
+
+
+def check_blocks(a, b, blocks):
+    assert blocks[-1] == (len(a), len(b), 0)
+    last_i = last_j = 0
+    for i, j, n in blocks:
+        assert i >= last_i and j >= last_j
+        assert a[i:i + n] == b[j:j + n]
+        last_i, last_j = i + n, j + n
+    return sum(n for _, _, n in blocks)
+
+
+def random_pairs(count=50):
+    rng = random.Random(0)
+    for _ in range(count):
+        a = [rng.randrange(6) for _ in range(rng.randrange(60))]
+        b = [rng.randrange(6) for _ in range(rng.randrange(60))]
+        yield a, b
+        b = a[:]
+        for _ in range(rng.randrange(10)):
+            b.insert(rng.randrange(len(b) + 1), rng.randrange(10))
+        yield a, b
+
+
+@pytest.mark.parametrize('memory_limit', [0, 10, 10000])
+def test_linear_matcher(memory_limit):
+    for a, b in random_pairs():
+        expected = check_blocks(a, b, MyersSequenceMatcher(None, a, b).get_matching_blocks())
+        matcher = LinearMyersSequenceMatcher(None, a, b, memory_limit=memory_limit)
+        assert check_blocks(a, b, matcher.get_matching_blocks()) == expected
+
+
+def test_discarded_lines():
+    a = list(range(50))
+    b = a[:]
+    for value in range(-1, -21, -1):
+        b.insert(-value * 2, value)
+    matcher = MyersSequenceMatcher(None, a, b)
+    assert check_blocks(a, b, matcher.get_matching_blocks()) == len(a)
+    assert matcher.lines_discarded
+    assert len(matcher.matching_blocks) == 22
+
+
+def test_max_cost():
+    for a, b in random_pairs():
+        exact = MyersSequenceMatcher(None, a, b)
+        expected = check_blocks(a, b, exact.get_matching_blocks())
+        assert not exact.approximate
+        matcher = MyersSequenceMatcher(None, a, b, max_cost=0)
+        assert check_blocks(a, b, matcher.get_matching_blocks()) <= expected
+
+
+def test_max_cost_anchors():
+    a = list(range(100))
+    b = a[60:] + a[:60]
+    matcher = MyersSequenceMatcher(None, a, b, max_cost=1)
+    assert matcher.get_matching_blocks() == [(0, 40, 60), (100, 100, 0)]
+    assert matcher.approximate
+
+
+def test_patience_matcher():
+    for a, b in random_pairs():
+        check_blocks(a, b, PatienceSequenceMatcher(None, a, b).get_matching_blocks())
+
+
+def test_patience_repeated():
+    rest, riff, fill = 0, 1, 2
+    a = [rest, riff, riff, rest, fill, riff, rest]
+    b = [rest, riff, rest, fill, riff, riff, rest]
+    matcher = PatienceSequenceMatcher(None, a, b)
+    assert matcher.get_opcodes()[1:3] == [('delete', 2, 3, 2, 2), ('equal', 3, 5, 2, 4)]
+
+
+def test_chunks():
+    for a, b in random_pairs():
+        matcher = MyersSequenceMatcher(None, a, b)
+        expected = difflib.SequenceMatcher.get_opcodes(matcher)
+        opcodes = matcher.get_opcodes()
+        assert isinstance(opcodes, Chunks)
+        assert opcodes == expected
+        assert list(matcher.get_difference_opcodes()) == [c for c in expected if c[0] != 'equal']
+        assert opcodes[1:-1] == expected[1:-1]
+        assert opcodes[-1:] == expected[-1:]
+        assert pickle.loads(pickle.dumps(opcodes)) == opcodes
@@ -0,0 +1,64 @@
+import threading
+
+import pytest
+
+from gpdiff import client, server
+from gpdiff.gpdiff import cli
+
+from test_gpdiff import make_song, set_note, write_songs
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    path = str(tmp_path / 'gpdiff.sock')
+    srv = server.Server(path, jobs=2)
+    thread = threading.Thread(target=srv.serve_forever)
+    thread.start()
+    yield path
+    srv.shutdown()
+    thread.join()
+    srv.server_close()
+
+
+def test_server(tmp_path, socket_path, capsys):
+    old, mine, yours = make_song(2), make_song(2), make_song(2)
+    set_note(mine.tracks[0].measures[0], 1)
+    set_note(yours.tracks[0].measures[0], 2)
+    files = write_songs(tmp_path, mine, old, yours)
+
+    response = client.request(socket_path, {'files': files[:2]})
+    assert response['status'] == 0
+    assert '[!| ] 1' in response['output']
+    response = client.request(socket_path, {'files': files, 'format': 'ndjson'})
+    assert response['status'] == 1
+    assert client.request(socket_path, {'command': 'stats'})['cache'] == {
+        'size': 3, 'maxsize': 64, 'hits': 2, 'misses': 3}
+
+    assert cli([files[1], files[0], files[2], '--connect', socket_path]) == 1
+    assert cli([files[1], files[0], '--connect', socket_path]) == 0
+    out = capsys.readouterr().out.splitlines()
+    assert out.count('[x| ] 1') == 1
+    assert out.count('[!| ] 1') == 1
+
+    response = client.request(socket_path, {'files': [str(tmp_path / 'missing.gp5')]})
+    assert response['status'] == 2
+    assert 'FileNotFoundError' in response['error']
+
+
+def test_song_cache_keys(tmp_path):
+    old, new = make_song(2), make_song(2)
+    set_note(new.tracks[1].measures[0], 1)
+    files = write_songs(tmp_path, old, new, make_song(3))
+    songs = server.SongCache(maxsize=1)
+
+    _, sequences, keys, interner = songs.load_all(files[:2])
+    assert keys[0][:10] == keys[1][:10]
+    assert keys[0] != keys[1]
+    assert [len(k) for k in keys] == [len(s) for s in sequences]
+    # Cached tokens aren't interned again
+    assert songs.load_all(files[1:2])[2][0] is keys[1]
+
+    # The interner holding elements of evicted songs is replaced
+    _, (sequence,), _, fresh = songs.load_all(files[2:])
+    assert fresh is not interner
+    assert len(fresh.table) == len(set(sequence))
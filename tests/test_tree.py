@@ -0,0 +1,56 @@
+import os
+import shutil
+
+import guitarpro
+
+from gpdiff import tree
+from gpdiff.gpdiff import cli
+
+from test_gpdiff import make_song, set_note
+
+
+def make_trees(tmp_path):
+    old_dir, new_dir = tmp_path / 'old', tmp_path / 'new'
+    for path in (old_dir / 'book', new_dir / 'book'):
+        path.mkdir(parents=True)
+    song = make_song()
+    guitarpro.write(song, str(old_dir / 'same.gp5'))
+    guitarpro.write(song, str(old_dir / 'book' / 'changed.gp5'))
+    guitarpro.write(song, str(old_dir / 'removed.gp4'), version=(4, 0, 0))
+    (old_dir / 'notes.txt').write_text('not a tab')
+    shutil.copy(old_dir / 'same.gp5', new_dir / 'same.gp5')
+    set_note(song.tracks[0].measures[1], 1)
+    guitarpro.write(song, str(new_dir / 'book' / 'changed.gp5'))
+    guitarpro.write(song, str(new_dir / 'added.gp3'), version=(3, 0, 0))
+    return str(old_dir), str(new_dir)
+
+
+def test_diff_trees(tmp_path):
+    old_dir, new_dir = make_trees(tmp_path)
+    diffed = []
+
+    def diff(old, new):
+        diffed.append((old, new))
+        return ['report']
+
+    result = list(tree.diff_trees(old_dir, new_dir, diff))
+    changed = os.path.join('book', 'changed.gp5')
+    assert result == [
+        ('added.gp3', 'added', []),
+        (changed, 'changed', ['report']),
+        ('removed.gp4', 'removed', []),
+        ('same.gp5', 'unchanged', []),
+    ]
+    assert diffed == [(os.path.join(old_dir, changed), os.path.join(new_dir, changed))]
+    assert tree.summarize([status for _, status, _ in result]) == \
+        '4 files: 1 changed, 1 added, 1 removed, 1 unchanged'
+
+
+def test_cli_trees(tmp_path, capsys):
+    old_dir, new_dir = make_trees(tmp_path)
+    assert cli([old_dir, new_dir, '-j', '2']) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert f'Only in {new_dir}: added.gp3' in lines
+    assert f'Only in {old_dir}: removed.gp4' in lines
+    assert '[!] 2' in lines
+    assert lines[-1] == '4 files: 1 changed, 1 added, 1 removed, 1 unchanged'